@@ -0,0 +1,132 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Admission control for the routes of a WSGIApplication.
+
+Every route belongs to a class with its own budget: at most limit requests
+run at once, at most queue more wait for a slot, and none waits longer than
+timeout seconds. A request over budget is answered at once with 503 and
+Retry-After, instead of piling up behind the database with everyone else.
+Static files, @view pages and the rest get separate budgets by default, so a
+burst of slow pages does not hold up cheap assets. Handlers marked with
+web.no_admission, such as the metrics endpoint, have no budget at all.
+"""
+
+__author__ = 'Henry Wang'
+
+import threading
+import time
+
+DEFAULT_CLASSES = {
+    'static': {'limit': 64, 'queue': 64, 'timeout': 0.1},
+    'view': {'limit': 8, 'queue': 16, 'timeout': 1.0},
+    'default': {'limit': 16, 'queue': 32, 'timeout': 1.0},
+}
+
+
+class Budget:
+    def __init__(self, name, limit, queue=0, timeout=0.0):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue or self.timeout <= 0:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def release_after(self, body):
+        """
+        Hold the slot until the server closes the body, that is until it has
+        been sent. A body that takes attributes, e.g. wsgi.file_wrapper, is
+        returned as it is so the server can still sendfile() it.
+        """
+        close = getattr(body, 'close', None)
+        released = []
+
+        def closing():
+            try:
+                if close is not None:
+                    close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.release()
+
+        try:
+            body.close = closing
+        except AttributeError:
+            return self._iterate(body, closing)
+        return body
+
+    @staticmethod
+    def _iterate(body, closing):
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            closing()
+
+
+class AdmissionController:
+    """
+    :param classes: {name: {'limit': n, 'queue': n, 'timeout': seconds}}, merged over DEFAULT_CLASSES
+    :param routes: {route path: class name} for routes that do not belong to their default class
+    :param retry_after: seconds sent in the Retry-After header of a 503
+    """
+
+    def __init__(self, classes=None, routes=None, retry_after=1):
+        options = dict(DEFAULT_CLASSES)
+        options.update(classes or {})
+        self.budgets = {name: Budget(name, **o) for name, o in options.items()}
+        self._routes = dict(routes or {})
+        self.retry_after = retry_after
+
+    def budget_for(self, route, default_class):
+        name = self._routes.get(route.path, default_class)
+        if name not in self.budgets:
+            raise ValueError('unknown admission class {} of route {}'.format(name, route.path))
+        return self.budgets[name]
+
+    def collect(self):
+        """
+        Prometheus lines of the budgets, for metrics.MetricsRegistry.add_collector.
+        """
+        lines = []
+        for name, kind, help, attr in (
+                ('admission_rejected_total', 'counter', 'Requests rejected with 503 by class.', 'rejected'),
+                ('admission_active', 'gauge', 'Requests holding a slot by class.', 'active'),
+                ('admission_waiting', 'gauge', 'Requests waiting for a slot by class.', 'waiting')):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for budget in sorted(self.budgets.values(), key=lambda b: b.name):
+                lines.append('{}{{class="{}"}} {}'.format(name, budget.name, getattr(budget, attr)))
+        return lines
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+ASGI adapter for the WSGI application built by web.WSGIApplication.
+
+Reading the request body and writing the response happen on the event loop,
+so slow clients only hold a coroutine. The WSGI callable and the iteration of
+its body run on a bounded thread pool inside one contextvars.Context per
+request, which carries web.ctx and the db connection of that request.
+"""
+
+__author__ = 'Henry Wang'
+
+import asyncio
+import contextvars
+import logging
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ASGIApplication:
+    def __init__(self, wsgi, max_workers=16, max_body_size=10 * 1024 * 1024, spool_size=512 * 1024):
+        self._wsgi = wsgi
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='asgi')
+        self._max_body_size = max_body_size
+        self._spool_size = spool_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('unsupported ASGI scope type {}'.format(scope['type']))
+        body, size = await self._read_body(receive)
+        if body is None:
+            return await self._send_simple(send, 413, b'Request Entity Too Large')
+        environ = self._build_environ(scope, body, size)
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+
+        def run(fn, *args):
+            return loop.run_in_executor(self._executor, context.run, fn, *args)
+
+        response = {}
+        # data passed to write(), sent ahead of the chunks of the iterable
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status[:3])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return written.append
+
+        async def send_body(chunk):
+            if not response.get('started'):
+                await self._start(send, response)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        async def send_written():
+            while written:
+                chunk = written.pop(0)
+                if chunk:
+                    await send_body(chunk)
+
+        try:
+            result = await run(self._wsgi, environ, start_response)
+            try:
+                iterator = iter(result)
+                while True:
+                    chunk = await run(next, iterator, None)
+                    await send_written()
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send_body(chunk)
+                if not response.get('started'):
+                    await self._start(send, response)
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    await run(result.close)
+        finally:
+            body.close()
+
+    @staticmethod
+    async def _start(send, response):
+        response['started'] = True
+        await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+
+    @staticmethod
+    async def _send_simple(send, status, body):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self._max_body_size:
+                body.close()
+                return None, size
+            body.write(chunk)
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+        return body, size
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _build_environ(scope, body, size):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(size),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        logging.debug('ASGI {} {}'.format(scope['method'], scope['path']))
+        return environ
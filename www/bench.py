@@ -0,0 +1,298 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the web framework, run in process without a server.
+
+The WSGI callables are driven directly with synthetic environs: route
+dispatch on a synthetic application, then the pages and JSON APIs of the
+blog against a sqlite database seeded with fixed data.
+
+    PYTHONPATH=transwarp python bench.py
+    PYTHONPATH=transwarp python bench.py --save baseline.json
+    PYTHONPATH=transwarp python bench.py --compare baseline.json
+
+--compare exits with status 1 when the p50 of a scenario got slower than
+--threshold percent, so it can guard a build.
+"""
+
+__author__ = 'Henry Wang'
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from web import WSGIApplication, Request, Response, get, page_cache
+
+
+def make_environ(path='/', method='GET', query_string='', headers=None, body=b''):
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '9000',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+    }
+    for k, v in (headers or {}).items():
+        name = k.upper().replace('-', '_')
+        # PEP 3333: the two body headers have no HTTP_ prefix
+        environ[name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name] = v
+    return environ
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def run_requests(app, environ, n):
+    for i in range(n):
+        for chunk in app(dict(environ), _start_response):
+            pass
+
+
+def _size_of(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def bench_hello(n=20000):
+    """
+    Time the hello-world path and measure what every request allocates.
+    """
+
+    @get('/')
+    def hello():
+        return 'hello, world'
+
+    wsgi = WSGIApplication('.')
+    wsgi.add_url(hello)
+    app = wsgi.get_wsgi_application()
+    environ = make_environ('/', headers={'User-Agent': 'bench', 'Accept': '*/*', 'Cookie': 'a=1; b=2'})
+    run_requests(app, environ, 1000)
+
+    start = time.perf_counter()
+    run_requests(app, environ, n)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    peak = 0
+    for i in range(1000):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        run_requests(app, environ, 1)
+        peak += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    request = Request(environ)
+    request.cookies
+    response = Response()
+    response.set_cookie('a', '1')
+    print('hello world: {:.1f} us/request, {:.0f} req/s'.format(elapsed / n * 1e6, n / elapsed))
+    print('  peak memory per request: {:.0f} bytes'.format(peak / 1000))
+    print('  Request object: {} bytes, Response object: {} bytes'.format(_size_of(request), _size_of(response)))
+
+
+class Scenario:
+    def __init__(self, name, app, path, query_string='', headers=None, expect='200'):
+        self.name = name
+        self.app = app
+        self.environ = make_environ(path, query_string=query_string, headers=headers)
+        self.expect = expect
+
+    def check(self):
+        status = []
+        body = b''.join(self.app(dict(self.environ), lambda s, h, e=None: status.append(s)))
+        if not status or not status[0].startswith(self.expect):
+            raise RuntimeError('{}: expected {}, got {} {!r}'.format(self.name, self.expect, status, body[:200]))
+
+    def run(self, n, warmup):
+        run_requests(self.app, self.environ, warmup)
+        timings = []
+        app, environ = self.app, self.environ
+        clock = time.perf_counter
+        for i in range(n):
+            start = clock()
+            for chunk in app(dict(environ), _start_response):
+                pass
+            timings.append(clock() - start)
+        timings.sort()
+        return {
+            'rps': n / sum(timings),
+            'p50': timings[len(timings) // 2] * 1e6,
+            'p99': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6,
+        }
+
+
+def dispatch_scenarios(routes=1000):
+    """
+    A synthetic application with routes static and routes dynamic paths,
+    under a few prefixes like the sections of a real site.
+    """
+    wsgi = WSGIApplication('.')
+    for i in range(routes):
+        @get('/static/path{}'.format(i))
+        def static_route():
+            return 'ok'
+
+        @get('/section{}/:id/path{}'.format(i % 10, i))
+        def dynamic_route(id):
+            return 'ok'
+
+        wsgi.add_url(static_route)
+        wsgi.add_url(dynamic_route)
+    app = wsgi.get_wsgi_application()
+    return [
+        Scenario('dispatch static', app, '/static/path{}'.format(routes - 1)),
+        Scenario('dispatch dynamic', app, '/section{}/42/path{}'.format((routes - 1) % 10, routes - 1)),
+        Scenario('dispatch 404', app, '/missing/path', expect='404'),
+    ]
+
+
+_BLOG_CONTENT = '\n\n'.join([
+    '## Section {0}',
+    'Some *emphasis*, some **strong text** and a [link](http://example.com/{0}). ' * 8,
+    '- first item\n- second item\n- third item',
+    '    def handler(request):\n        return render(request)',
+    '> a quoted paragraph that goes on for a while ' * 4,
+])
+
+
+def seed_database(path, blogs=30, comments=50):
+    """
+    Create the tables of the models in a sqlite file and fill them with
+    fixed data. Returns the id of the blog with the comments.
+    """
+    import sqlite3
+    import db
+    from models import User, Blog, Comment
+
+    rnd = random.Random(2015)
+    conn = sqlite3.connect(path)
+    for model in (User, Blog, Comment):
+        conn.executescript(model.__sql__(None))
+    conn.close()
+    db.create_sqlite_engine(path)
+    now = time.time()
+    # Model.insert() prints what it inserts
+    with contextlib.redirect_stdout(io.StringIO()):
+        with db.transaction():
+            admin = User(name='admin', email='admin@example.com', password='0' * 32, admin=True,
+                         image='about:blank', created_at=now - 86400 * 30).insert()
+            users = [User(name='user{}'.format(i), email='user{}@example.com'.format(i), password='0' * 32,
+                          admin=False, image='about:blank', created_at=now - 86400 * 20 + i).insert()
+                     for i in range(10)]
+            blog_ids = []
+            for i in range(blogs):
+                blog = Blog(user_id=admin.id, user_name=admin.name, user_image=admin.image,
+                            name='Blog {}'.format(i), summary='Summary of blog {} '.format(i) * 3,
+                            content='\n\n'.join(_BLOG_CONTENT.format(i * 10 + s) for s in range(4)),
+                            created_at=now - 86400 * (blogs - i)).insert()
+                blog_ids.append(blog.id)
+            for i in range(comments):
+                user = rnd.choice(users)
+                Comment(blog_id=blog_ids[-1], user_id=user.id, user_name=user.name, user_image=user.image,
+                        content='Comment {} '.format(i) * 5, created_at=now - 3600 * (comments - i)).insert()
+    return blog_ids[-1]
+
+
+def blog_scenarios(db_path):
+    """
+    The blog application of urls.py as wsgiapp.py sets it up, with the page
+    cache off so every page is rendered.
+    """
+    from web import Jinja2TemplateEngine
+    blog_id = seed_database(db_path)
+    import urls
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    wsgi = WSGIApplication(root)
+    engine = Jinja2TemplateEngine(os.path.join(root, 'templates'))
+    # stands in for wsgiapp.datetime_filter, importing wsgiapp connects to MySQL
+    engine.add_filter('datetime', lambda t: time.strftime('%Y-%m-%d', time.localtime(t)))
+    wsgi.template_engine = engine
+    wsgi.add_interceptor(urls.user_interceptor)
+    wsgi.add_interceptor(urls.manager_interceptor)
+    wsgi.add_module(urls)
+    page_cache.configure(max_bytes=0)
+    app = wsgi.get_wsgi_application()
+    return [
+        Scenario('view blogs.html', app, '/'),
+        Scenario('view blog.html', app, '/blog/{}'.format(blog_id)),
+        Scenario('api blogs', app, '/api/blogs', query_string='page=2'),
+        Scenario('api blog', app, '/api/blogs/{}'.format(blog_id)),
+        Scenario('api comments', app, '/api/comments'),
+    ]
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print('\n{:<20} {:>10} {:>10}'.format('compared to baseline', 'p50', 'req/s'))
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print('{:<20} {:>10} {:>10}'.format(name, 'new', 'new'))
+            continue
+        p50 = (r['p50'] / base['p50'] - 1) * 100
+        rps = (r['rps'] / base['rps'] - 1) * 100
+        flag = ''
+        if p50 > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<20} {:>+9.1f}% {:>+9.1f}%{}'.format(name, p50, rps, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process benchmarks of the WSGI application.')
+    parser.add_argument('-n', type=int, default=2000, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=200, help='untimed requests per scenario')
+    parser.add_argument('--only', help='run the scenarios whose name contains this text')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=10.0, help='p50 slowdown in percent to fail on')
+    parser.add_argument('--routes', type=int, default=1000, help='routes of the dispatch scenarios')
+    parser.add_argument('--hello', action='store_true', help='run the hello-world micro-benchmark only')
+    args = parser.parse_args()
+
+    if args.hello:
+        bench_hello()
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scenarios = dispatch_scenarios(args.routes) + blog_scenarios(os.path.join(tmp, 'bench.db'))
+        if args.only:
+            scenarios = [s for s in scenarios if args.only in s.name]
+        results = {}
+        print('{:<20} {:>10} {:>10} {:>10}'.format('scenario', 'req/s', 'p50 us', 'p99 us'))
+        for scenario in scenarios:
+            scenario.check()
+            r = results[scenario.name] = scenario.run(args.n, args.warmup)
+            print('{:<20} {:>10.0f} {:>10.1f} {:>10.1f}'.format(scenario.name, r['rps'], r['p50'], r['p99']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=sys.version.split()[0], results=results), f, indent=2, sort_keys=True)
+        print('\nsaved baseline to {}'.format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,65 @@ configs={
         'port': 3306,
         'user': 'www-data',
         'passwd': 'www-data',
-        'database': 'awesome'
+        'database': 'awesome',
+        'pool': {
+            'min_size': 2,
+            'max_size': 10,
+            'timeout': 10,
+            'max_idle': 300,
+            'max_age': 3600
+        }
     },
     'session': {
         'secret': 'AwEsOmE'
+    },
+    'session_store': {
+        'backend': 'memory',
+        # of the file backend, a relative directory is under the application
+        'directory': 'cache/sessions',
+        'ttl': 1800,
+        'flush_interval': 0.5
+    },
+    'user_cache': {
+        'max_entries': 10000,
+        # seconds another worker may still accept a changed user's old cookie
+        'ttl': 10
+    },
+    'static': {
+        'max_age': 86400,
+        'cache_dir': 'cache/static',
+        'precompress': True
+    },
+    'compression': {
+        'level': 6,
+        'min_size': 1024
+    },
+    # 'prefork' reloads on SIGHUP by importing app_module, 'wsgiapp:application' by default
+    'server': {
+        'server': 'wsgiref',
+        # None is on for 'wsgiref' only, the workers of every generation use the same value
+        'debug': None
+    },
+    'templates': {
+        'cache_bytecode': True,
+        'bytecode_cache_dir': None,
+        'auto_reload': True,
+        # compile every template at startup, this imports jinja2 before the first request
+        'precompile': False,
+        'stream': True
+    },
+    'cache': {
+        'max_bytes': 32 * 1024 * 1024,
+        'ttl': 60
+    },
+    # e.g. {'path': '/metrics', 'allow': ['127.0.0.1'], 'token': '...'} to serve Prometheus metrics
+    'metrics': None,
+    # e.g. {'directory': 'cache/profiles', 'secret': '...', 'sample_rate': 0.0, 'max_files': 100}
+    # to profile requests, the secret signs X-Profile headers and must be kept private
+    'profiling': None,
+    'admission': {
+        'retry_after': 1,
+        # budgets that replace those of admission.DEFAULT_CLASSES, e.g. {'view': {'limit': 4, 'queue': 8, 'timeout': 1.0}}
+        'classes': None
     }
 }
\ No newline at end of file
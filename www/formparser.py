@@ -0,0 +1,281 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Incremental parser for urlencoded and multipart/form-data request bodies.
+
+The body is read from wsgi.input in fixed size chunks, never as a whole.
+Plain fields are kept in memory up to max_field_size, file parts are spooled
+to a temporary file once they grow over spool_size.
+"""
+
+__author__ = 'Henry Wang'
+
+import re
+import tempfile
+import urllib.parse
+from io import BytesIO
+
+
+def _import_json_loads():
+    """
+    Pick the fastest JSON decoder installed, falling back to the stdlib.
+    """
+    for name in ('orjson', 'ujson'):
+        try:
+            return __import__(name).loads
+        except ImportError:
+            pass
+    import json
+    return json.loads
+
+
+_json_loads = None
+
+
+def json_loads(data):
+    """
+    Decode a JSON body. The decoder is picked on first use, so importing this
+    module does not import orjson.
+    """
+    global _json_loads
+    if _json_loads is None:
+        _json_loads = _import_json_loads()
+    return _json_loads(data)
+
+
+class FormError(ValueError):
+    pass
+
+
+class BodyTooLargeError(FormError):
+    pass
+
+
+_RE_OPTION = re.compile(r';\s*([^=;\s]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+def parse_options_header(value):
+    """
+    Split a header like 'form-data; name="a"; filename="b.txt"' into
+    ('form-data', {'name': 'a', 'filename': 'b.txt'}).
+    """
+    main, _, rest = value.partition(';')
+    options = {}
+    for k, v in _RE_OPTION.findall(';' + rest):
+        v = v.strip()
+        if len(v) >= 2 and v[0] == v[-1] == '"':
+            v = v[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        options[k.lower()] = v
+    return main.strip().lower(), options
+
+
+class UploadedFile:
+    def __init__(self, name, filename, content_type, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+    @property
+    def value(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def __str__(self):
+        return 'UploadedFile({},filename={},size={})'.format(self.name, self.filename, self.size)
+
+    __repr__ = __str__
+
+
+class _Part:
+    def __init__(self, name, filename, content_type, parser):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self._parser = parser
+        if filename is None:
+            self._file = BytesIO()
+        else:
+            self._file = tempfile.SpooledTemporaryFile(max_size=parser.spool_size)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.filename is None and self.size > self._parser.max_field_size:
+            raise BodyTooLargeError('field {} is too large'.format(self.name))
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def finish(self):
+        if self.filename is None:
+            return self._file.getvalue().decode(self._parser.encoding, 'replace')
+        self._file.seek(0)
+        return UploadedFile(self.name, self.filename, self.content_type, self._file, self.size)
+
+
+class FormParser:
+    """
+    Parse the query string and body of a WSGI request into a list of
+    (name, value) pairs. Values are str, UploadedFile for file parts, or
+    any JSON value for JSON bodies.
+    """
+
+    max_header_size = 8192
+
+    def __init__(self, max_body_size=10 * 1024 * 1024, max_field_size=1024 * 1024, spool_size=512 * 1024,
+                 chunk_size=65536, encoding='utf-8'):
+        self.max_body_size = max_body_size
+        self.max_field_size = max_field_size
+        self.spool_size = spool_size
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+
+    def is_json(self, environ):
+        content_type = parse_options_header(environ.get('CONTENT_TYPE', ''))[0]
+        return content_type == 'application/json' or content_type.endswith('+json')
+
+    def read_body(self, environ):
+        return b''.join(self.chunks(environ))
+
+    def parse_json(self, body):
+        if not body:
+            return None
+        try:
+            return json_loads(body)
+        except ValueError:
+            raise FormError('invalid JSON body')
+
+    def parse(self, environ):
+        """
+        (name, value) pairs of the query string and a form body. A JSON body is
+        left to the caller, see parse_json.
+        """
+        pairs = self._parse_qs(environ.get('QUERY_STRING', ''))
+        if environ.get('REQUEST_METHOD', 'GET') not in ('POST', 'PUT', 'PATCH'):
+            return pairs
+        content_type, options = parse_options_header(environ.get('CONTENT_TYPE', ''))
+        if content_type == 'application/x-www-form-urlencoded':
+            pairs.extend(self._parse_urlencoded(self.chunks(environ)))
+        elif content_type == 'multipart/form-data':
+            boundary = options.get('boundary')
+            if not boundary:
+                raise FormError('missing multipart boundary')
+            pairs.extend(self._parse_multipart(self.chunks(environ), boundary.encode('latin-1')))
+        return pairs
+
+    def content_length(self, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise FormError('invalid Content-Length')
+        if length > self.max_body_size:
+            raise BodyTooLargeError('request body is too large')
+        return length
+
+    def chunks(self, environ):
+        fp = environ['wsgi.input']
+        remaining = self.content_length(environ)
+        while remaining > 0:
+            chunk = fp.read(min(self.chunk_size, remaining))
+            if not chunk:
+                raise FormError('request body is truncated')
+            remaining -= len(chunk)
+            yield chunk
+
+    def _parse_qs(self, qs):
+        return urllib.parse.parse_qsl(qs, keep_blank_values=True, encoding=self.encoding, errors='replace')
+
+    def _parse_urlencoded(self, chunks):
+        buf = b''
+        for chunk in chunks:
+            buf += chunk
+            pos = buf.rfind(b'&')
+            if pos >= 0:
+                head = buf[:pos]
+                # a chunk may hold a whole field that is too large
+                if len(head) > self.max_field_size and max(map(len, head.split(b'&'))) > self.max_field_size:
+                    raise BodyTooLargeError('field is too large')
+                for pair in self._parse_qs(head.decode(self.encoding, 'replace')):
+                    yield pair
+                buf = buf[pos + 1:]
+            if len(buf) > self.max_field_size:
+                raise BodyTooLargeError('field is too large')
+        if buf:
+            for pair in self._parse_qs(buf.decode(self.encoding, 'replace')):
+                yield pair
+
+    def _parse_multipart(self, chunks, boundary):
+        parts = []
+        try:
+            return self._read_parts(chunks, boundary, parts)
+        except BaseException:
+            # drop the spooled files of a body that is not used
+            for part in parts:
+                part.close()
+            raise
+
+    def _read_parts(self, chunks, boundary, parts):
+        delimiter = b'--' + boundary
+        separator = b'\r\n' + delimiter
+        buf = bytearray()
+        state = 'preamble'
+        part = None
+        pairs = []
+        for chunk in chunks:
+            buf += chunk
+            while True:
+                if state == 'preamble':
+                    pos = buf.find(delimiter)
+                    if pos < 0:
+                        del buf[:-len(delimiter)]
+                        break
+                    del buf[:pos + len(delimiter)]
+                    state = 'delimiter'
+                if state == 'delimiter':
+                    if len(buf) < 2:
+                        break
+                    if buf[:2] == b'--':
+                        return pairs
+                    if buf[:2] != b'\r\n':
+                        raise FormError('malformed multipart delimiter')
+                    del buf[:2]
+                    state = 'headers'
+                if state == 'headers':
+                    pos = buf.find(b'\r\n\r\n')
+                    if pos < 0:
+                        if len(buf) > self.max_header_size:
+                            raise FormError('multipart headers are too large')
+                        break
+                    part = self._new_part(bytes(buf[:pos]))
+                    parts.append(part)
+                    del buf[:pos + 4]
+                    state = 'body'
+                if state == 'body':
+                    pos = buf.find(separator)
+                    if pos < 0:
+                        keep = len(separator) - 1
+                        if len(buf) > keep:
+                            part.write(bytes(buf[:-keep]))
+                            del buf[:-keep]
+                        break
+                    part.write(bytes(buf[:pos]))
+                    del buf[:pos + len(separator)]
+                    pairs.append((part.name, part.finish()))
+                    state = 'delimiter'
+        raise FormError('multipart body is truncated')
+
+    def _new_part(self, data):
+        headers = {}
+        for line in data.decode(self.encoding, 'replace').split('\r\n'):
+            k, sep, v = line.partition(':')
+            if sep:
+                headers[k.strip().lower()] = v.strip()
+        disposition, options = parse_options_header(headers.get('content-disposition', ''))
+        if disposition != 'form-data' or 'name' not in options:
+            raise FormError('invalid multipart Content-Disposition')
+        return _Part(options['name'], options.get('filename'),
+                     headers.get('content-type', 'application/octet-stream'), self)
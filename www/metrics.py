@@ -0,0 +1,392 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Request and database metrics in the Prometheus text format.
+
+Every thread updates its own shard of the registry, a plain dict no other
+thread writes to, so recording a value takes no lock. The shards are only
+summed when the metrics are rendered, the shards of threads that have ended
+are folded into a total then. Each process keeps its own registry, a
+pre-forked server therefore reports the numbers of the worker that answers
+the scrape.
+"""
+
+__author__ = 'Henry Wang'
+
+import contextvars
+import hmac
+import threading
+import types
+from bisect import bisect_left
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(k, _escape(v)) for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    def __init__(self, registry, name, help, kind, labels, buckets=None):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) if buckets else None
+
+    def inc(self, labels=(), value=1):
+        shard = self._registry._shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def dec(self, labels=(), value=1):
+        self.inc(labels, -value)
+
+    def observe(self, labels, value):
+        shard = self._registry._shard()
+        key = (self.name, labels)
+        cell = shard.get(key)
+        if cell is None:
+            cell = shard[key] = [0] * (len(self.buckets) + 3)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def render(self, values):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for labels, value in sorted(values.items()):
+            if self.kind != 'histogram':
+                lines.append('{}{} {}'.format(self.name, _format_labels(self.labels, labels), _format_value(value)))
+                continue
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), value):
+                total += count
+                le = 'le="{}"'.format(_format_value(bound))
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labels, labels, le), total))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labels, labels), _format_value(value[-2])))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labels, labels), value[-1]))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms keyed by a tuple of label values, in the
+    order of the label names given when the metric was declared.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        # [(thread, shard)], and the sum of the shards of ended threads
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        # called with the lock held
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self._retired, shard)
+        self._shards = alive
+
+    def _declare(self, name, help, kind, labels, buckets=None):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = _Metric(self, name, help, kind, labels, buckets)
+        elif metric.kind != kind:
+            raise ValueError('metric {} is already declared as a {}'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._declare(name, help, 'counter', labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._declare(name, help, 'gauge', labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._declare(name, help, 'histogram', labels, sorted(buckets))
+
+    def add_collector(self, fn):
+        """
+        fn() is called on every render and returns the text lines of metrics
+        kept elsewhere, e.g. the sizes of caches.
+        """
+        self._collectors.append(fn)
+
+    def collect(self):
+        """
+        Sum the shards of all threads into {name: {label values: value}}.
+        """
+        totals = {}
+        with self._lock:
+            self._retire()
+            shards = [dict(self._retired)] + [shard for thread, shard in self._shards]
+        for shard in shards:
+            for (name, labels), value in list(shard.items()):
+                values = totals.setdefault(name, {})
+                if isinstance(value, list):
+                    cell = values.get(labels)
+                    values[labels] = list(value) if cell is None else [a + b for a, b in zip(cell, value)]
+                else:
+                    values[labels] = values.get(labels, 0) + value
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.extend(metric.render(totals.get(name, {})))
+        for fn in self._collectors:
+            lines.extend(fn())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _merge(total, shard):
+    """
+    Add the values of shard to total. Lists are replaced, not changed in
+    place, so a copy of total taken under the lock stays consistent.
+    """
+    for key, value in list(shard.items()):
+        current = total.get(key)
+        if current is None:
+            total[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            total[key] = [a + b for a, b in zip(current, value)]
+        else:
+            total[key] = current + value
+
+
+registry = MetricsRegistry()
+
+_request_db = contextvars.ContextVar('metrics_request_db', default=None)
+
+
+def authorized(environ, allow=(), token=None):
+    """
+    Whether a scrape may read the metrics: it comes from an address in allow
+    or carries 'Authorization: Bearer <token>'. Behind a proxy on the same
+    host every client has the address of the proxy, use a token there.
+    """
+    if token:
+        header = environ.get('HTTP_AUTHORIZATION', '')
+        if header.startswith('Bearer ') and hmac.compare_digest(header[7:].encode('utf-8'),
+                                                                token.encode('utf-8')):
+            return True
+    return environ.get('REMOTE_ADDR') in allow
+
+
+def record_statement(sql, elapsed):
+    """
+    Listener for db.add_statement_listener, adds a statement to the totals of
+    the current request.
+    """
+    cell = _request_db.get()
+    if cell is not None:
+        cell[0] += 1
+        cell[1] += elapsed
+
+
+class RequestMetrics:
+    """
+    WSGI middleware recording per route request counts by status, latency,
+    bytes sent, requests in flight and the database time of each request.
+
+    The route label is the route pattern put in environ['transwarp.route'] by
+    the application, so the number of series does not grow with the URLs.
+    Streamed bodies are measured until their last chunk is sent. A request
+    updates a single per-thread cell, the metrics are built from the cells
+    when the registry is rendered.
+    """
+
+    def __init__(self, registry=registry, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._db_offset = 6 + len(self._buckets) + 1
+        self._size = self._db_offset + len(self._buckets) + 1
+        self._shards = []
+        self._retired = [0, {}]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests = _Metric(None, 'http_requests_total', 'Requests by method, route and status.', 'counter',
+                                ('method', 'route', 'status'))
+        self.latency = _Metric(None, 'http_request_duration_seconds', 'Request latency by route.', 'histogram',
+                               ('route',), self._buckets)
+        self.in_flight = _Metric(None, 'http_requests_in_flight', 'Requests being handled.', 'gauge', ())
+        self.bytes = _Metric(None, 'http_response_bytes_total', 'Response body bytes by route.', 'counter',
+                             ('route',))
+        self.db_statements = _Metric(None, 'db_statements_total', 'Database statements by route.', 'counter',
+                                     ('route',))
+        self.db_latency = _Metric(None, 'db_duration_seconds', 'Database time per request by route.', 'histogram',
+                                  ('route',), self._buckets)
+        registry.add_collector(self.render)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = [0, {}]
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        # called with the lock held
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._retired[0] += shard[0]
+                _merge(self._retired[1], shard[1])
+        self._shards = alive
+
+    def wrap(self, app):
+        def metered(environ, start_response):
+            start = perf_counter()
+            self._shard()[0] += 1
+            db = [0, 0.0]
+            _request_db.set(db)
+            state = ['500', None]
+
+            def _start_response(status, headers, exc_info=None):
+                state[0] = status[:3]
+                state[1] = headers
+                return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+
+            try:
+                body = app(environ, _start_response)
+            except BaseException:
+                self._finish(environ, state[0], start, 0, db)
+                raise
+            if isinstance(body, list):
+                self._finish(environ, state[0], start, sum(map(len, body)), db)
+                return body
+            if isinstance(body, types.GeneratorType):
+                return self._iterate(body, environ, state, start, db)
+            # e.g. wsgi.file_wrapper: keep the object so the server can still
+            # sendfile() it, and measure until the server closes it
+            size = 0
+            for k, v in state[1] or ():
+                if k.lower() == 'content-length':
+                    size = int(v)
+            close = getattr(body, 'close', None)
+
+            def closing():
+                try:
+                    if close is not None:
+                        close()
+                finally:
+                    self._finish(environ, state[0], start, size, db)
+
+            try:
+                body.close = closing
+            except AttributeError:
+                return self._iterate(body, environ, state, start, db)
+            return body
+
+        return metered
+
+    def _iterate(self, body, environ, state, start, db):
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._finish(environ, state[0], start, size, db)
+
+    def _finish(self, environ, status, start, size, db):
+        """
+        Cell layout: count, bytes, statements, latency sum, db time sum,
+        requests with db time, latency buckets, db time buckets.
+        """
+        elapsed = perf_counter() - start
+        cells = self._shard()[1]
+        key = (environ.get('REQUEST_METHOD', ''), environ.get('transwarp.route', ''), status)
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = [0] * self._size
+        cell[0] += 1
+        cell[1] += size
+        cell[3] += elapsed
+        cell[6 + bisect_left(self._buckets, elapsed)] += 1
+        if db[0]:
+            cell[2] += db[0]
+            cell[4] += db[1]
+            cell[5] += 1
+            cell[self._db_offset + bisect_left(self._buckets, db[1])] += 1
+
+    def render(self):
+        with self._lock:
+            self._retire()
+            shards = [[self._retired[0], dict(self._retired[1])]] + [shard for thread, shard in self._shards]
+        started = 0
+        cells = {}
+        for shard in shards:
+            started += shard[0]
+            for key, cell in list(shard[1].items()):
+                total = cells.get(key)
+                cells[key] = list(cell) if total is None else [a + b for a, b in zip(total, cell)]
+        n = len(self._buckets) + 1
+        requests, latency, size, statements, db_latency = {}, {}, {}, {}, {}
+        finished = 0
+        for (method, route, status), cell in cells.items():
+            finished += cell[0]
+            requests[(method, route, status)] = cell[0]
+            r = (route,)
+            size[r] = size.get(r, 0) + cell[1]
+            _add_histogram(latency, r, cell[6:6 + n], cell[3], cell[0])
+            if cell[5]:
+                statements[r] = statements.get(r, 0) + cell[2]
+                _add_histogram(db_latency, r, cell[self._db_offset:self._db_offset + n], cell[4], cell[5])
+        lines = []
+        lines.extend(self.requests.render(requests))
+        lines.extend(self.latency.render(latency))
+        lines.extend(self.in_flight.render({(): started - finished}))
+        lines.extend(self.bytes.render(size))
+        lines.extend(self.db_statements.render(statements))
+        lines.extend(self.db_latency.render(db_latency))
+        return lines
+
+
+def _add_histogram(values, labels, buckets, total, count):
+    cell = buckets + [total, count]
+    current = values.get(labels)
+    values[labels] = cell if current is None else [a + b for a, b in zip(current, cell)]
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Run single requests under cProfile and keep the stats.
+
+A request is profiled when it carries a valid signed X-Profile header, or at
+random with probability sample_rate. The stats are written to directory as
+<time in ms>-<method>-<route>-<ms>ms.pstats, readable with pstats or snakeviz,
+and only the newest max_files are kept. Other requests only pay a header
+lookup, and nothing at all when neither a secret nor a sample rate is
+configured.
+
+Sign a header for a path from a shell that has the secret:
+
+    python profiling.py SECRET /api/blogs
+"""
+
+__author__ = 'Henry Wang'
+
+import cProfile
+import hashlib
+import hmac
+import logging
+import os
+import random
+import re
+import threading
+import time
+import types
+
+_RE_UNSAFE = re.compile(r'[^A-Za-z0-9]+')
+
+
+def sign(secret, path, expires):
+    """
+    Value of the X-Profile header that allows profiling path until expires.
+    """
+    message = '{}:{}'.format(expires, path).encode('utf-8')
+    digest = hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+    return '{}:{}'.format(expires, digest)
+
+
+class RequestProfiler:
+    def __init__(self, directory, secret=None, sample_rate=0.0, header='X-Profile', max_files=100):
+        self._directory = directory
+        self._secret = secret
+        self._sample_rate = sample_rate
+        self._header = 'HTTP_' + header.upper().replace('-', '_')
+        self._max_files = max_files
+        # cProfile cannot run in two threads at once on newer Pythons, so
+        # requests arriving while another one is profiled run unprofiled.
+        self._busy = threading.Lock()
+        if self.enabled:
+            from web import _private_directory
+            _private_directory(directory)
+
+    @property
+    def enabled(self):
+        return bool(self._secret) or self._sample_rate > 0
+
+    def _verify(self, value, path):
+        expires, _, digest = value.partition(':')
+        try:
+            if int(expires) < time.time():
+                return False
+        except ValueError:
+            return False
+        return hmac.compare_digest(sign(self._secret, path, expires), value)
+
+    def _wanted(self, environ):
+        value = environ.get(self._header)
+        if value is not None and self._secret and self._verify(value, environ.get('PATH_INFO', '')):
+            return True
+        return self._sample_rate > 0 and random.random() < self._sample_rate
+
+    def wrap(self, app):
+        if not self.enabled:
+            return app
+
+        def profiled(environ, start_response):
+            if not self._wanted(environ) or not self._busy.acquire(blocking=False):
+                return app(environ, start_response)
+            try:
+                return self._run(app, environ, start_response)
+            finally:
+                self._busy.release()
+
+        return profiled
+
+    def _run(self, app, environ, start_response):
+        """
+        A streamed body is read to the end inside the profile and sent as a
+        list, so the stats cover the rendering of the whole response.
+        """
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            body = app(environ, start_response)
+            if isinstance(body, types.GeneratorType):
+                stream = body
+                try:
+                    body = list(stream)
+                finally:
+                    stream.close()
+        finally:
+            profile.disable()
+        self._dump(profile, environ, time.perf_counter() - start)
+        return body
+
+    def _dump(self, profile, environ, elapsed):
+        route = environ.get('transwarp.route') or environ.get('PATH_INFO', '')
+        now = time.time()
+        stamp = '{}{:03d}'.format(time.strftime('%Y%m%d%H%M%S', time.localtime(now)), int(now * 1000) % 1000)
+        name = '{}-{}-{}-{}ms.pstats'.format(stamp, environ.get('REQUEST_METHOD', ''),
+                                             _RE_UNSAFE.sub('_', route).strip('_') or 'root', int(elapsed * 1000))
+        try:
+            path = os.path.join(self._directory, name)
+            profile.dump_stats(path)
+            self._prune()
+        except OSError as e:
+            logging.warning('cannot write profile of {}: {}'.format(route, e))
+            return
+        logging.info('profiled {} {} in {:.1f} ms: {}'.format(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                                                           elapsed * 1000, path))
+
+    def _prune(self):
+        # the names start with the time, so they sort oldest first
+        names = sorted(name for name in os.listdir(self._directory) if name.endswith('.pstats'))
+        for name in names[:max(len(names) - self._max_files, 0)]:
+            os.remove(os.path.join(self._directory, name))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print('usage: python profiling.py SECRET PATH [SECONDS]')
+        sys.exit(1)
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    print('X-Profile: {}'.format(sign(sys.argv[1], sys.argv[2], int(time.time()) + seconds)))
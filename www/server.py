@@ -0,0 +1,733 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Production servers for WSGIApplication.run.
+
+PreforkServer binds once in the master and forks workers after the
+application has been imported, so they share its memory copy-on-write.
+The master respawns workers that die or reach max_requests and shuts them
+down gracefully on SIGTERM/SIGINT.
+
+SIGHUP reloads without dropping requests: the master forks a new generation
+of workers which import app_module afresh, so they run the code now on disk,
+and warm up. Once all of them report ready the old generation stops
+accepting, finishes its in-flight requests and exits, or is killed after
+graceful_timeout seconds. A new generation that fails to start is stopped and
+the old one keeps serving.
+
+    kill -HUP $(cat /tmp/awesome.pid)
+
+ThreadPoolServer is a single process HTTP/1.1 server that keeps connections
+alive and serves their requests from a fixed pool of threads. Idle
+connections wait in a selector, not in a thread.
+"""
+
+__author__ = 'Henry Wang'
+
+import errno
+import gc
+import importlib.util
+import logging
+import os
+import queue
+import select
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.util import setup_testing_defaults
+
+
+def _listen(host, port, backlog, reuse_port=False):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class _WorkerWSGIServer(WSGIServer):
+    """
+    A WSGIServer serving on a socket that was bound by someone else.
+    """
+
+    def __init__(self, sock, app, handler_class):
+        WSGIServer.__init__(self, sock.getsockname()[:2], handler_class, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        self.requests = 0
+
+    def process_request(self, request, client_address):
+        self.requests += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+def _import_app(app_module, root):
+    """
+    Import 'module:attribute' after dropping every module loaded from under
+    root, so the application and everything it imports is read from disk again.
+    """
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path and name != '__main__' and os.path.abspath(path).startswith(root + os.sep):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+    module_name, _, attr = app_module.partition(':')
+    return getattr(importlib.import_module(module_name), attr or 'application')
+
+
+class _Child:
+    __slots__ = ('started', 'generation', 'ready_fd', 'ready', 'kill_at')
+
+    def __init__(self, generation, ready_fd):
+        self.started = time.time()
+        self.generation = generation
+        self.ready_fd = ready_fd
+        self.ready = False
+        # when a worker asked to stop gets SIGKILL, None while it is serving
+        self.kill_at = None
+
+
+class PreforkServer:
+    def __init__(self, app, host='127.0.0.1', port=9000, workers=0, max_requests=0, reuse_port=False,
+                 backlog=128, graceful_timeout=30, handler_class=WSGIRequestHandler, app_module=None,
+                 warmup=(), reload_timeout=60, pidfile=None):
+        """
+        :param app: the WSGI callable, built before forking
+        :param workers: number of worker processes, 0 means one per CPU
+        :param max_requests: recycle a worker after this many requests, 0 means never
+        :param reuse_port: let every worker bind its own SO_REUSEPORT socket
+        :param graceful_timeout: seconds a worker may take to finish in-flight requests
+        :param app_module: 'module:attribute' of app, imported again by the workers started on SIGHUP
+        :param warmup: paths a worker requests itself before it takes traffic, to fill caches and pools
+        :param reload_timeout: seconds a new generation may take to get ready
+        :param pidfile: file to write the pid of the master to
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.handler_class = handler_class
+        self.app_module = app_module
+        self.warmup = tuple(warmup)
+        self.reload_timeout = reload_timeout
+        self.pidfile = pidfile
+        self._app_root = None
+        if app_module:
+            spec = importlib.util.find_spec(app_module.partition(':')[0])
+            if spec is None or not spec.origin:
+                raise ValueError('cannot find the module of {}'.format(app_module))
+            self._app_root = os.path.dirname(os.path.abspath(spec.origin))
+        self._socket = None
+        self._children = {}
+        # generation of the workers taking traffic, and the last one started,
+        # which only goes up so workers of a failed reload never mix with later ones
+        self._serving = 0
+        self._generation = 0
+        self._stopping = False
+        self._reloading = False
+        self._alive = True
+
+    # master
+
+    def run(self):
+        if not self.reuse_port:
+            self._socket = _listen(self.host, self.port, self.backlog)
+        logging.info('prefork master {} starts {} workers at {}:{}'.format(os.getpid(), self.workers,
+                                                                          self.host, self.port))
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        if self.pidfile:
+            with open(self.pidfile, 'w') as f:
+                f.write('{}\n'.format(os.getpid()))
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        try:
+            while not self._stopping:
+                self._reap()
+                self._kill_overdue()
+                if self._reloading:
+                    self._reloading = False
+                    self._reload()
+                self._spawn_missing()
+                time.sleep(0.5)
+        finally:
+            self._shutdown()
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        self._reloading = True
+
+    def _spawn_missing(self):
+        while not self._stopping:
+            current = sum(1 for c in self._children.values() if c.generation == self._serving)
+            if current >= self.workers:
+                return
+            self._spawn(self._serving)
+
+    def _spawn(self, generation):
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(ready_w)
+            self._children[pid] = _Child(generation, ready_r)
+            return pid
+        status = 0
+        try:
+            os.close(ready_r)
+            self._worker(ready_w, generation)
+        except Exception:
+            logging.exception('worker {} crashed'.format(os.getpid()))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if pid == 0:
+                return
+            child = self._children.pop(pid, None)
+            if child is None:
+                continue
+            os.close(child.ready_fd)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                logging.info('worker {} exited'.format(pid))
+            else:
+                logging.warning('worker {} died with status {}'.format(pid, status))
+                if time.time() - child.started < 1:
+                    # do not spin when workers crash right after start
+                    time.sleep(1)
+
+    def _poll_ready(self, pids, timeout):
+        fds = {self._children[pid].ready_fd: self._children[pid] for pid in pids}
+        try:
+            readable = select.select(list(fds), [], [], timeout)[0]
+        except InterruptedError:
+            return
+        for fd in readable:
+            # a closed pipe without data means the worker died while starting
+            if os.read(fd, 1):
+                fds[fd].ready = True
+
+    def _reload(self):
+        """
+        Start a new generation of workers and retire the current one once all
+        new workers are ready. Blocks the master until then, the old workers
+        keep serving meanwhile.
+        """
+        old = self._serving
+        self._generation += 1
+        generation = self._generation
+        if not self.app_module:
+            logging.warning('no app_module given, the new workers run the code of the master')
+        logging.info('prefork master {} starts generation {}'.format(os.getpid(), generation))
+        new = [self._spawn(generation) for i in range(self.workers)]
+        deadline = time.time() + self.reload_timeout
+        while not self._stopping:
+            self._reap()
+            self._kill_overdue()
+            if any(pid not in self._children for pid in new):
+                error = 'a worker died while starting'
+                break
+            waiting = [pid for pid in new if not self._children[pid].ready]
+            if not waiting:
+                logging.info('generation {} is ready, stopping generation {}'.format(generation, old))
+                self._serving = generation
+                self._retire(lambda c: c.generation != generation)
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                error = 'timed out after {} seconds'.format(self.reload_timeout)
+                break
+            self._poll_ready(waiting, min(remaining, 0.5))
+        else:
+            return
+        logging.error('reload to generation {} failed: {}, generation {} keeps serving'.format(
+            generation, error, old))
+        self._retire(lambda c: c.generation == generation)
+
+    def _retire(self, which):
+        """
+        SIGTERM the workers for which which(child) is true, they get
+        graceful_timeout seconds to finish their requests before SIGKILL.
+        """
+        kill_at = time.time() + self.graceful_timeout
+        for child in self._children.values():
+            if which(child) and child.kill_at is None:
+                child.kill_at = kill_at
+        self._signal_children(signal.SIGTERM, which)
+
+    def _kill_overdue(self):
+        now = time.time()
+        for pid, child in list(self._children.items()):
+            if child.kill_at is not None and child.kill_at <= now:
+                logging.warning('worker {} did not stop in {} seconds, killing it'.format(
+                    pid, self.graceful_timeout))
+                child.kill_at = None
+                self._signal_children(signal.SIGKILL, lambda c: c is child)
+
+    def _shutdown(self):
+        logging.info('prefork master {} stopping {} workers'.format(os.getpid(), len(self._children)))
+        self._signal_children(signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self._children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        if self._children:
+            self._signal_children(signal.SIGKILL)
+            while self._children:
+                self._reap()
+                time.sleep(0.1)
+        if self._socket is not None:
+            self._socket.close()
+        if self.pidfile:
+            try:
+                os.remove(self.pidfile)
+            except OSError:
+                pass
+
+    def _signal_children(self, signum, which=None):
+        for pid, child in list(self._children.items()):
+            if which is not None and not which(child):
+                continue
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    self._children.pop(pid, None)
+
+    # worker
+
+    def _handle_worker_stop(self, signum, frame):
+        self._alive = False
+
+    def _warm_up(self, app):
+        for path in self.warmup:
+            environ = {'PATH_INFO': path, 'HTTP_USER_AGENT': 'transwarp-warmup'}
+            setup_testing_defaults(environ)
+            try:
+                body = app(environ, lambda status, headers, exc_info=None: None)
+                try:
+                    for chunk in body:
+                        pass
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+            except Exception:
+                logging.exception('warm-up request {} of worker {} failed'.format(path, os.getpid()))
+
+    def _worker(self, ready_fd, generation):
+        for child in self._children.values():
+            os.close(child.ready_fd)
+        self._children = {}
+        master = os.getppid()
+        signal.signal(signal.SIGTERM, self._handle_worker_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        app = self.app
+        if generation and self.app_module:
+            app = _import_app(self.app_module, self._app_root)
+        sock = self._socket
+        if sock is None:
+            sock = _listen(self.host, self.port, self.backlog, reuse_port=True)
+        sock.setblocking(False)
+        server = _WorkerWSGIServer(sock, app, self.handler_class)
+        self._warm_up(app)
+        os.write(ready_fd, b'.')
+        os.close(ready_fd)
+        logging.info('worker {} of generation {} started'.format(os.getpid(), generation))
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            while self._alive:
+                if self.max_requests and server.requests >= self.max_requests:
+                    logging.info('worker {} reached max_requests {}'.format(os.getpid(), self.max_requests))
+                    break
+                if os.getppid() != master:
+                    logging.warning('worker {} lost its master'.format(os.getpid()))
+                    break
+                if selector.select(1.0):
+                    server._handle_request_noblock()
+            if self.reuse_port:
+                # connections queued on a SO_REUSEPORT socket are reset when
+                # it is closed, so serve what has arrived before exiting
+                while selector.select(0):
+                    server._handle_request_noblock()
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper of ThreadPoolServer. A response made of one is sent
+    with socket.sendfile when its length is known.
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), b'')
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+class _InputStream:
+    """
+    wsgi.input limited to Content-Length, so an application can never read
+    into the next request of a persistent connection.
+    """
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit):
+        """
+        Skip the unread body. Returns False when more than limit bytes are
+        left, in which case the connection should be closed instead.
+        """
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(65536):
+                return False
+        return True
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """
+    Serve WSGI requests over a persistent HTTP/1.1 connection. Responses
+    without Content-Length use chunked transfer encoding.
+
+    The handler serves the requests that have arrived and returns, leaving
+    close_connection False when the server should keep the connection for
+    the next one.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'transwarp/1.0'
+    max_drain = 65536
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._pending():
+            self.handle_one_request()
+
+    def _pending(self):
+        """
+        Whether the next request has arrived, read ahead into rfile or
+        waiting in the socket, without blocking for it.
+        """
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def __getattr__(self, name):
+        if name.startswith('do_'):
+            return self.run_wsgi
+        raise AttributeError(name)
+
+    def run_wsgi(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.send_error(411)
+            self.close_connection = True
+            return
+        environ = self.get_environ()
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self.send_error(400)
+            self.close_connection = True
+            return
+        stream = _InputStream(self.rfile, length)
+        environ.update(self.server.wsgi_environ)
+        environ['wsgi.input'] = stream
+        self._status = None
+        self._response_headers = None
+        self._headers_sent = False
+        self._chunked = False
+        self._has_body = self.command != 'HEAD'
+        try:
+            result = self.server.get_app()(environ, self._start_response)
+            try:
+                self._send_result(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            logging.exception('error in WSGI application')
+            if self._headers_sent:
+                self.close_connection = True
+                return
+            self.send_error(500)
+            self.close_connection = True
+            return
+        if not stream.drain(self.max_drain):
+            self.close_connection = True
+
+    def _start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self._headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        elif self._status is not None:
+            raise AssertionError('start_response() called twice')
+        self._status = status
+        self._response_headers = headers
+        return self._write
+
+    def _send_result(self, result):
+        if isinstance(result, (list, tuple)) and self._header('Content-Length') is None:
+            self._response_headers.append(('Content-Length', str(sum(map(len, result)))))
+        if isinstance(result, FileWrapper) and self._header('Content-Length') is not None and self._has_body:
+            self._send_headers()
+            self.wfile.flush()
+            self.connection.sendfile(result.filelike)
+            return
+        for data in result:
+            if data:
+                self._write(data)
+        if not self._headers_sent:
+            self._send_headers()
+        if self._chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _header(self, name):
+        name = name.lower()
+        for k, v in self._response_headers:
+            if k.lower() == name:
+                return v
+        return None
+
+    def _send_headers(self):
+        code = int(self._status[:3])
+        self.send_response(code, self._status[4:])
+        for k, v in self._response_headers:
+            self.send_header(k, v)
+        if code < 200 or code in (204, 304):
+            self._has_body = False
+        elif self._header('Content-Length') is None:
+            if self.request_version == 'HTTP/1.1':
+                self._chunked = self._has_body
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version != 'HTTP/1.1':
+            self.send_header('Connection', 'keep-alive')
+        self.end_headers()
+        self._headers_sent = True
+
+    def _write(self, data):
+        if self._status is None:
+            raise AssertionError('write() before start_response()')
+        if not self._headers_sent:
+            self._send_headers()
+        if not self._has_body:
+            return
+        if self._chunked:
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('latin-1') + data + b'\r\n')
+        else:
+            self.wfile.write(data)
+
+
+class ThreadPoolServer(WSGIServer):
+    """
+    Accept connections on one thread and serve their requests on a fixed
+    pool of worker threads.
+
+    A connection only holds a worker while a request is read and answered.
+    Between requests it is parked in a selector run by its own thread, and
+    handed to a worker when it becomes readable again; connections idle for
+    idle_timeout seconds are closed there. Readable connections wait in a
+    queue of queue_size when every worker is busy, beyond that they get an
+    immediate 503.
+    """
+
+    def __init__(self, app, host='127.0.0.1', port=9000, threads=16, backlog=128, idle_timeout=5,
+                 queue_size=64, handler_class=KeepAliveHandler, multiprocess=False):
+        """
+        :param threads: number of worker threads
+        :param backlog: listen() backlog of the accept socket
+        :param idle_timeout: seconds a persistent connection may stay idle or stall a read
+        :param queue_size: readable connections not yet picked up by a worker
+        """
+        self.request_queue_size = backlog
+        self.idle_timeout = idle_timeout
+        WSGIServer.__init__(self, (host, port), handler_class)
+        self.set_app(app)
+        self.wsgi_environ = {
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': multiprocess,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        self._queue = queue.Queue(queue_size)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._returned = []
+        self._returned_lock = threading.Lock()
+        self._parked = {}
+        self._closing = False
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._work, name='http-worker-{}'.format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._parking = threading.Thread(target=self._run_parking, name='http-keepalive', daemon=True)
+        self._parking.start()
+
+    def process_request(self, request, client_address):
+        # a new connection waits for its first request like an idle one
+        self._park(request, client_address)
+
+    def _park(self, request, client_address):
+        with self._returned_lock:
+            self._returned.append((request, client_address))
+        self._wakeup()
+
+    def _run_parking(self):
+        while not self._closing:
+            for key, mask in self._selector.select(1.0):
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                del self._parked[key.fileobj]
+                self._dispatch(key.fileobj, key.data)
+            with self._returned_lock:
+                returned, self._returned = self._returned, []
+            now = time.monotonic()
+            for request, client_address in returned:
+                try:
+                    self._selector.register(request, selectors.EVENT_READ, client_address)
+                except (ValueError, OSError):
+                    # closed meanwhile
+                    self.shutdown_request(request)
+                    continue
+                self._parked[request] = now
+            for request, since in list(self._parked.items()):
+                if now - since > self.idle_timeout:
+                    self._selector.unregister(request)
+                    del self._parked[request]
+                    self.shutdown_request(request)
+
+    def _dispatch(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            logging.warning('request queue is full, reject {}'.format(client_address[0]))
+            try:
+                request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n'
+                                b'Retry-After: 1\r\nConnection: close\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            keep = False
+            try:
+                handler = self.RequestHandlerClass(request, client_address, self)
+                keep = not handler.close_connection
+            except Exception:
+                self.handle_error(request, client_address)
+            if keep and not self._closing:
+                self._park(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self._closing = True
+        self._wakeup()
+        self._parking.join()
+        with self._returned_lock:
+            requests = list(self._parked) + [request for request, client_address in self._returned]
+            self._returned = []
+        for request in requests:
+            self.shutdown_request(request)
+        self._parked.clear()
+        self._selector.close()
+        for t in self._threads:
+            self._queue.put(None)
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'.')
+        except OSError:
+            pass
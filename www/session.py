@@ -0,0 +1,331 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Server-side sessions, loaded on the first use of ctx.request.session.
+
+The cookie only carries a random session id. The data lives in a backend:
+MemoryBackend keeps it in the process behind striped locks, FileBackend
+keeps one file per session so the pre-forked workers of a host share it.
+
+Sessions expire ttl seconds after their last renewal. A session is renewed,
+and its cookie sent again, once less than renew_fraction of its ttl is left,
+so an active user stays signed in without a write on every request.
+
+Changed sessions are written back in batches every flush_interval seconds by
+a thread of each process, a flush_interval of 0 writes them at the end of the
+request. With batching, another worker may read a session that is up to
+flush_interval old.
+"""
+
+__author__ = 'Henry Wang'
+
+import atexit
+import binascii
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from web import _private_directory
+
+_RE_SID = re.compile(r'^[0-9a-f]{32}$')
+
+# marks a session deleted in the write-back queue
+_DELETED = object()
+
+
+def _new_sid():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class Session(dict):
+    """
+    The data of a session. Assigning keys marks it modified, changes inside a
+    stored value are not seen unless the value is assigned again.
+    """
+
+    def __init__(self, sid, data, expires, new=False):
+        super(Session, self).__init__(data)
+        self.sid = sid
+        self.expires = expires
+        self.new = new
+        self.modified = False
+        self.renewed = False
+        self.invalidated = False
+
+    def __setitem__(self, key, value):
+        self.modified = True
+        super(Session, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.modified = True
+        super(Session, self).__delitem__(key)
+
+    def clear(self):
+        self.modified = True
+        super(Session, self).clear()
+
+    def pop(self, *args):
+        self.modified = True
+        return super(Session, self).pop(*args)
+
+    def popitem(self):
+        self.modified = True
+        return super(Session, self).popitem()
+
+    def setdefault(self, key, default=None):
+        self.modified = True
+        return super(Session, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.modified = True
+        super(Session, self).update(*args, **kwargs)
+
+    def invalidate(self):
+        """
+        Delete the session and its cookie, e.g. on sign out.
+        """
+        self.clear()
+        self.invalidated = True
+
+
+class MemoryBackend:
+    """
+    Sessions of a single process. The ids are spread over stripes, each with
+    its own lock, so concurrent requests rarely wait for each other.
+    """
+
+    def __init__(self, stripes=16):
+        self._stripes = [(threading.Lock(), {}) for i in range(stripes)]
+
+    def _stripe(self, sid):
+        return self._stripes[hash(sid) % len(self._stripes)]
+
+    def load(self, sid):
+        lock, entries = self._stripe(sid)
+        with lock:
+            return entries.get(sid)
+
+    def save(self, sid, data, expires):
+        lock, entries = self._stripe(sid)
+        with lock:
+            entries[sid] = (data, expires)
+
+    def touch(self, sid, expires):
+        lock, entries = self._stripe(sid)
+        with lock:
+            entry = entries.get(sid)
+            if entry is not None:
+                entries[sid] = (entry[0], expires)
+
+    def delete(self, sid):
+        lock, entries = self._stripe(sid)
+        with lock:
+            entries.pop(sid, None)
+
+    def cleanup(self, now):
+        for lock, entries in self._stripes:
+            with lock:
+                for sid in [sid for sid, entry in entries.items() if entry[1] <= now]:
+                    del entries[sid]
+
+
+class FileBackend:
+    """
+    One JSON file per session under directory, shared by the processes of a
+    host. The expiry time is the modification time of the file, so renewing
+    a session is a utime() instead of a rewrite. The directories are private
+    to the user running the application, nobody else may read the sessions
+    or plant one.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        _private_directory(directory)
+
+    def _path(self, sid):
+        return os.path.join(self._directory, sid[:2], sid)
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid), 'rb') as f:
+                expires = os.fstat(f.fileno()).st_mtime
+                return json.loads(f.read().decode('utf-8')), expires
+        except (OSError, ValueError):
+            return None
+
+    def save(self, sid, data, expires):
+        path = self._path(sid)
+        _private_directory(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(data).encode('utf-8'))
+            os.utime(tmp, (expires, expires))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def touch(self, sid, expires):
+        try:
+            os.utime(self._path(sid), (expires, expires))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self, now):
+        for dirpath, dirnames, filenames in os.walk(self._directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_mtime <= now:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class SessionStore:
+    def __init__(self, backend, ttl=1800, cookie_name='transwarp_sid', renew_fraction=0.5, flush_interval=0.5,
+                 cleanup_interval=60, secure=False):
+        self.backend = backend
+        self.ttl = ttl
+        self.cookie_name = cookie_name
+        self._renew_before = ttl * renew_fraction
+        self._flush_interval = flush_interval
+        self._cleanup_interval = cleanup_interval
+        self._secure = secure
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+        self._last_cleanup = time.monotonic()
+
+    def open(self, sid):
+        """
+        The session of sid, or a new empty one when sid is missing, unknown
+        or expired. A new session is only stored once something is put in it.
+        """
+        now = time.time()
+        if sid and _RE_SID.match(sid):
+            record = self._load(sid)
+            if record is not None and record[1] > now:
+                session = Session(sid, record[0], record[1])
+                if record[1] - now < self._renew_before:
+                    session.expires = now + self.ttl
+                    session.renewed = True
+                return session
+        return Session(_new_sid(), {}, now + self.ttl, new=True)
+
+    def _load(self, sid):
+        with self._lock:
+            pending = self._pending.get(sid)
+        if pending is None:
+            return self.backend.load(sid)
+        data, expires = pending
+        if data is _DELETED:
+            return None
+        if data is None:
+            record = self.backend.load(sid)
+            return (record[0], expires) if record is not None else None
+        return dict(data), expires
+
+    def save(self, session, response):
+        """
+        Queue the changes of a session at the end of its request and send the
+        cookie when the session is new, renewed or deleted.
+        """
+        if session.invalidated:
+            if not session.new:
+                self._queue(session.sid, _DELETED, 0)
+                response.delete_cookie(self.cookie_name)
+            return
+        if session.new:
+            if not session:
+                return
+            self._queue(session.sid, dict(session), session.expires)
+        elif session.modified:
+            self._queue(session.sid, dict(session), session.expires)
+        elif session.renewed:
+            self._queue(session.sid, None, session.expires)
+        else:
+            return
+        if session.new or session.renewed:
+            response.set_cookie(self.cookie_name, session.sid, max_age=self.ttl, secure=self._secure)
+
+    def _queue(self, sid, data, expires):
+        if self._flush_interval <= 0:
+            self._write(sid, data, expires)
+            self._maybe_cleanup()
+            return
+        with self._lock:
+            previous = self._pending.get(sid)
+            if data is None and previous is not None and previous[0] is not _DELETED:
+                data = previous[0]
+            self._pending[sid] = (data, expires)
+            if self._flusher_pid != os.getpid():
+                self._start_flusher()
+
+    def _write(self, sid, data, expires):
+        if data is _DELETED:
+            self.backend.delete(sid)
+        elif data is None:
+            self.backend.touch(sid, expires)
+        else:
+            self.backend.save(sid, data, expires)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for sid, (data, expires) in pending.items():
+            try:
+                self._write(sid, data, expires)
+            except Exception as e:
+                logging.exception(e)
+
+    def _start_flusher(self):
+        # called with the lock held, once per process: the thread of the
+        # master does not survive in forked workers
+        first = self._flusher_pid is None
+        self._flusher_pid = os.getpid()
+        if first:
+            atexit.register(self.flush)
+        threading.Thread(target=self._run_flusher, name='session-flusher', daemon=True).start()
+
+    def _run_flusher(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self._flush_interval)
+            self.flush()
+            self._maybe_cleanup()
+
+    def _maybe_cleanup(self):
+        if time.monotonic() - self._last_cleanup < self._cleanup_interval:
+            return
+        self._last_cleanup = time.monotonic()
+        try:
+            self.backend.cleanup(time.time())
+        except Exception as e:
+            logging.exception(e)
+
+
+def create_store(backend='memory', stripes=16, directory=None, **kwargs):
+    """
+    :param backend: 'memory' for MemoryBackend, 'file' for FileBackend in directory
+    :param kwargs: options of SessionStore
+    """
+    if backend == 'memory':
+        return SessionStore(MemoryBackend(stripes), **kwargs)
+    if backend == 'file':
+        if not directory:
+            raise ValueError('the file session backend needs a directory')
+        return SessionStore(FileBackend(directory), **kwargs)
+    raise ValueError('unknown session backend {}'.format(backend))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Startup timings of the application.
+
+wsgiapp.py times the phases of building the application with phase(). Run
+this module to see how long a cold start takes and where the time goes:
+
+    python startup.py
+    python startup.py --budget 500
+
+It imports the application in a fresh interpreter with -X importtime, prints
+the slowest imports, the phases and the total, and exits with status 1 when
+the total is over --budget milliseconds, so it can guard a build.
+"""
+
+__author__ = 'Henry Wang'
+
+import contextlib
+import time
+
+_phases = []
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+
+def phases():
+    """
+    [(name, seconds)] of the phases run so far, in order.
+    """
+    return list(_phases)
+
+
+_CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import startup
+import {module}
+total = time.perf_counter() - start
+sys.stdout.flush()
+print('\\n' + json.dumps(dict(total=total, phases=startup.phases())))
+'''
+
+
+def _parse_importtime(stderr):
+    """
+    [(cumulative us, self us, name)] of the lines written by -X importtime,
+    the name indented by its nesting depth.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+    return imports
+
+
+def report(module='wsgiapp', top=15):
+    import json
+    import os
+    import subprocess
+    import sys
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (here, os.path.join(here, 'transwarp'), env.get('PYTHONPATH')) if p)
+    start = time.perf_counter()
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', _CHILD.format(module=module)],
+                           cwd=here, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+    process = time.perf_counter() - start
+    if child.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, child.stderr[-4000:]))
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+
+    imports = sorted(_parse_importtime(child.stderr), reverse=True)[:top]
+    print('{:>10} {:>10}  {}'.format('cum ms', 'self ms', 'slowest imports'))
+    for cumulative, own, name in imports:
+        print('{:>10.1f} {:>10.1f} {}'.format(cumulative / 1000, own / 1000, name))
+    print('\n{:>10}  {}'.format('ms', 'phases'))
+    for name, seconds in result['phases']:
+        print('{:>10.1f}  {}'.format(seconds * 1000, name))
+    print('\n{:>10.1f}  import {}'.format(result['total'] * 1000, module))
+    print('{:>10.1f}  whole process, with the interpreter'.format(process * 1000))
+    return result['total']
+
+
+def main():
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Report the cold start time of the application.')
+    parser.add_argument('--module', default='wsgiapp', help='module that builds the application')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to show')
+    parser.add_argument('--budget', type=float, default=1000, help='milliseconds the import may take')
+    args = parser.parse_args()
+    total = report(args.module, args.top) * 1000
+    if args.budget and total > args.budget:
+        print('\nover budget: {:.1f} ms > {:.1f} ms'.format(total, args.budget))
+        sys.exit(1)
+    print('\nwithin budget of {:.1f} ms'.format(args.budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,11 +16,12 @@ function showError(err) {
     }
 }
 
-function _ajax(method, url, data, callback) {
+function _ajax(method, url, data, callback, contentType) {
     $.ajax({
         type: method,
         url: url,
         data: data,
+        contentType: contentType || 'application/x-www-form-urlencoded; charset=UTF-8',
         dataType: 'json'
     }).done(function(r) {
         if (r && r.error) {
@@ -45,7 +46,7 @@ function postApi(url, data, callback) {
         callback = data;
         data = {};
     }
-    _ajax('POST', url, data, callback);
+    _ajax('POST', url, JSON.stringify(data), callback, 'application/json; charset=UTF-8');
 }
 
 function startLoading() {
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3.4
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the incremental form parser, run from www/:
+
+    python -m unittest test_formparser
+"""
+
+__author__ = 'Henry Wang'
+
+import io
+import unittest
+
+from formparser import FormParser, FormError, BodyTooLargeError, UploadedFile
+
+CHUNK_SIZES = (1, 2, 3, 7, 64, 65536)
+
+BOUNDARY = 'xYzZY'
+
+# the file holds most of a delimiter, which must not end the part
+FILE_DATA = b'GIF89a\r\n--xYzZ\r\n-xYzZY\x00\xff' * 50
+
+
+def _environ(body, content_type, method='POST', query_string='', content_length=None):
+    return {
+        'REQUEST_METHOD': method,
+        'QUERY_STRING': query_string,
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body) if content_length is None else content_length),
+        'wsgi.input': io.BytesIO(body),
+    }
+
+
+def _multipart(*parts, boundary=BOUNDARY, end=True):
+    lines = []
+    for headers, data in parts:
+        lines.append(b'--' + boundary.encode('latin-1') + b'\r\n' + headers + b'\r\n\r\n' + data)
+    body = b'preamble\r\n' + b'\r\n'.join(lines)
+    if end:
+        body += b'\r\n--' + boundary.encode('latin-1') + b'--\r\nepilogue'
+    return body
+
+
+def _field(name, value):
+    return 'Content-Disposition: form-data; name="{}"'.format(name).encode('utf-8'), value
+
+
+def _file(name, filename, data):
+    headers = 'Content-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: image/gif'.format(
+        name, filename)
+    return headers.encode('utf-8'), data
+
+
+MULTIPART = _multipart(_field('title', 'Hello, 世界'.encode('utf-8')),
+                       _field('empty', b''),
+                       _file('avatar', 'a.gif', FILE_DATA),
+                       _field('title', b'again'))
+
+
+class MultipartTest(unittest.TestCase):
+    def parse(self, body, chunk_size=65536, boundary=BOUNDARY, **kwargs):
+        parser = FormParser(chunk_size=chunk_size, **kwargs)
+        return parser.parse(_environ(body, 'multipart/form-data; boundary="{}"'.format(boundary)))
+
+    def test_every_chunk_size(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                pairs = self.parse(MULTIPART, chunk_size)
+                self.assertEqual([name for name, value in pairs], ['title', 'empty', 'avatar', 'title'])
+                self.assertEqual(pairs[0][1], 'Hello, 世界')
+                self.assertEqual(pairs[1][1], '')
+                self.assertEqual(pairs[3][1], 'again')
+                upload = pairs[2][1]
+                self.assertIsInstance(upload, UploadedFile)
+                self.assertEqual((upload.filename, upload.content_type, upload.size),
+                                 ('a.gif', 'image/gif', len(FILE_DATA)))
+                self.assertEqual(upload.value, FILE_DATA)
+
+    def test_boundary_split_across_chunks(self):
+        body = _multipart(_field('a', b'x' * 10), _field('b', b'y'))
+        # every split of the body into two reads
+        for cut in range(1, len(body)):
+            with self.subTest(cut=cut):
+                parser = FormParser(chunk_size=cut)
+                pairs = parser.parse(_environ(body, 'multipart/form-data; boundary=' + BOUNDARY))
+                self.assertEqual(pairs, [('a', 'x' * 10), ('b', 'y')])
+
+    def test_large_file_is_spooled(self):
+        pairs = self.parse(MULTIPART, 64, spool_size=100)
+        upload = pairs[2][1]
+        self.assertTrue(upload.file._rolled)
+        self.assertEqual(upload.value, FILE_DATA)
+
+    def test_field_over_max_field_size(self):
+        body = _multipart(_field('a', b'x' * 101))
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                with self.assertRaises(BodyTooLargeError):
+                    self.parse(body, chunk_size, max_field_size=100)
+        self.assertEqual(self.parse(_multipart(_field('a', b'x' * 100)), 7, max_field_size=100),
+                         [('a', 'x' * 100)])
+
+    def test_files_are_not_limited_by_max_field_size(self):
+        pairs = self.parse(_multipart(_file('f', 'f.bin', b'x' * 1000)), 7, max_field_size=100)
+        self.assertEqual(pairs[0][1].size, 1000)
+
+    def test_body_over_max_body_size(self):
+        with self.assertRaises(BodyTooLargeError):
+            self.parse(MULTIPART, max_body_size=len(MULTIPART) - 1)
+
+    def test_headers_too_large(self):
+        body = _multipart((b'Content-Disposition: form-data; name="a"\r\nX-Pad: ' + b'p' * 9000, b'x'))
+        with self.assertRaises(FormError):
+            self.parse(body, 64)
+
+    def test_truncated_body(self):
+        for cut in (5, len(MULTIPART) // 2, len(MULTIPART) - len('--\r\nepilogue') - 1):
+            with self.subTest(cut=cut):
+                for chunk_size in CHUNK_SIZES:
+                    with self.assertRaises(FormError):
+                        self.parse(MULTIPART[:cut], chunk_size)
+
+    def test_missing_closing_delimiter(self):
+        body = _multipart(_field('a', b'x'), end=False)
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                with self.assertRaises(FormError):
+                    self.parse(body, chunk_size)
+
+    def test_input_shorter_than_content_length(self):
+        parser = FormParser(chunk_size=7)
+        environ = _environ(MULTIPART[:len(MULTIPART) // 2], 'multipart/form-data; boundary=' + BOUNDARY,
+                           content_length=len(MULTIPART))
+        with self.assertRaises(FormError):
+            parser.parse(environ)
+
+    def test_missing_boundary(self):
+        for content_type in ('multipart/form-data', 'multipart/form-data; boundary=',
+                             'multipart/form-data; charset=utf-8'):
+            with self.subTest(content_type=content_type):
+                with self.assertRaises(FormError):
+                    FormParser().parse(_environ(MULTIPART, content_type))
+
+    def test_other_boundary_in_body(self):
+        # the body never has the boundary of the header
+        with self.assertRaises(FormError):
+            self.parse(MULTIPART, 7, boundary='other')
+
+    def test_malformed_delimiter(self):
+        body = MULTIPART.replace(b'--' + BOUNDARY.encode() + b'\r\nContent-Disposition: form-data; name="empty"',
+                                 b'--' + BOUNDARY.encode() + b'XXContent-Disposition: form-data; name="empty"')
+        with self.assertRaises(FormError):
+            self.parse(body, 3)
+
+    def test_part_without_name(self):
+        with self.assertRaises(FormError):
+            self.parse(_multipart((b'Content-Disposition: form-data', b'x')))
+
+
+class UrlencodedTest(unittest.TestCase):
+    BODY = 'a=1&b=%E4%B8%96%E7%95%8C&a=2&empty=&c=x+y'.encode('ascii')
+
+    def parse(self, body, chunk_size=65536, **kwargs):
+        parser = FormParser(chunk_size=chunk_size, **kwargs)
+        return parser.parse(_environ(body, 'application/x-www-form-urlencoded', query_string='q=1'))
+
+    def test_every_chunk_size(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.parse(self.BODY, chunk_size),
+                                 [('q', '1'), ('a', '1'), ('b', '世界'), ('a', '2'), ('empty', ''), ('c', 'x y')])
+
+    def test_field_over_max_field_size(self):
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                with self.assertRaises(BodyTooLargeError):
+                    self.parse(b'a=' + b'x' * 200 + b'&b=1', chunk_size, max_field_size=100)
+
+    def test_body_over_max_body_size(self):
+        with self.assertRaises(BodyTooLargeError):
+            self.parse(self.BODY, max_body_size=len(self.BODY) - 1)
+
+    def test_truncated_body(self):
+        parser = FormParser(chunk_size=7)
+        environ = _environ(self.BODY, 'application/x-www-form-urlencoded', content_length=len(self.BODY) + 1)
+        with self.assertRaises(FormError):
+            parser.parse(environ)
+
+    def test_body_of_get_is_ignored(self):
+        parser = FormParser()
+        self.assertEqual(parser.parse(_environ(self.BODY, 'application/x-www-form-urlencoded', method='GET')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
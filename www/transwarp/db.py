@@ -1,9 +1,11 @@
 __author__ = 'linaro'
 
-import threading
+import contextvars
 import logging
+import os
+import threading
 from functools import wraps
-from time import time
+from time import time, perf_counter
 from nameddict import Nameddict
 
 def _profiling(start,sql=''):
@@ -12,21 +14,36 @@ def _profiling(start,sql=''):
         logging.warning('[Profiling] [DB] {} {}'.format(t,sql))
     logging.info('[Profiling] [DB] {} {}'.format(t,sql))
 
+_statement_listeners=[]
+
+def add_statement_listener(fn):
+    '''
+    fn(sql,elapsed) is called after every statement run by select and update,
+    elapsed in seconds.
+    '''
+    _statement_listeners.append(fn)
+
+def _notify_statement(sql,start):
+    elapsed=perf_counter()-start
+    for fn in _statement_listeners:
+        fn(sql,elapsed)
+
 class DBError(Exception):
     pass
 
 class MultiColumnsError(DBError):
     pass
 
+class PoolTimeoutError(DBError):
+    pass
+
 class _LazyConnection:
     def __init__(self):
         self.connection=None
 
     def cursor(self):
         if self.connection is None:
-            connection=engine.connect()
-            logging.info('open connection {}'.format(hex(id(connection))))
-            self.connection=connection
+            self.connection=engine.pool.checkout()
         return self.connection.cursor()
 
     def commit(self):
@@ -35,28 +52,220 @@ class _LazyConnection:
     def roolback(self):
         self.connection.rollback()
 
+    def rollback(self):
+        self.connection.rollback()
+
     def cleanup(self):
         if self.connection:
             connection=self.connection
             self.connection=None
-            logging.info('close connection {}'.format(hex(id(connection))))
-            connection.close()
+            engine.pool.release(connection)
+
 
+def _reset(connection):
+    # with autocommit off even a select opens a transaction, which would pin
+    # an old snapshot for the next user of the connection
+    if getattr(connection,'in_transaction',True):
+        connection.rollback()
 
+def _close(connection):
+    try:
+        connection.close()
+    except Exception as e:
+        logging.warning('error closing connection {}: {}'.format(hex(id(connection)),e))
+
+class _Pool:
+    '''
+    The connections of an engine, shared by the threads of a process.
+
+    A connection is checked out on the first statement of a connection or
+    transaction scope and returned, rolled back, at its end. The connection
+    returned last is handed out first, so spare ones sit idle and are closed
+    after max_idle seconds while min_size stay open. Connections are
+    replaced after max_age seconds, and pinged before being handed out when
+    they have been idle for more than ping_after seconds. Connections are
+    opened on demand, never ahead of time.
+    '''
+    def __init__(self,connect,ping=None,min_size=0,max_size=10,timeout=10.0,max_idle=300.0,max_age=3600.0,
+                 ping_after=1.0):
+        self._connect=connect
+        self._ping=ping
+        self.min_size=min_size
+        self.max_size=max_size
+        self.timeout=timeout
+        self.max_idle=max_idle
+        self.max_age=max_age
+        self.ping_after=ping_after
+        self._init_state()
+
+    def _init_state(self):
+        self._cond=threading.Condition(threading.Lock())
+        # [connection,opened,last returned], the most recently returned last
+        self._idle=[]
+        self._opened={}
+        self._size=0
+        self._in_use=0
+        self._stats=dict(checkouts=0,waits=0,wait_seconds=0.0,timeouts=0,opened=0,closed=0,broken=0)
+
+    def after_fork(self):
+        '''
+        Forget the connections of the parent process without closing them,
+        closing would end the sessions the parent is still using.
+        '''
+        self._init_state()
+
+    def checkout(self):
+        closing=[]
+        start=None
+        try:
+            with self._cond:
+                self._stats['checkouts']+=1
+                while True:
+                    now=time()
+                    if self._idle:
+                        connection,opened,returned=self._idle.pop()
+                        if now-opened>=self.max_age:
+                            self._forget(connection)
+                            closing.append(connection)
+                            continue
+                        break
+                    if self._size<self.max_size:
+                        self._size+=1
+                        connection=None
+                        break
+                    if start is None:
+                        start=perf_counter()
+                        self._stats['waits']+=1
+                    remaining=start+self.timeout-perf_counter()
+                    if remaining<=0:
+                        self._stats['timeouts']+=1
+                        self._stats['wait_seconds']+=perf_counter()-start
+                        raise PoolTimeoutError('no free connection after {} seconds'.format(self.timeout))
+                    self._cond.wait(remaining)
+                if start is not None:
+                    self._stats['wait_seconds']+=perf_counter()-start
+                self._in_use+=1
+        finally:
+            for c in closing:
+                _close(c)
+        if connection is not None and self._ping is not None and now-returned>self.ping_after:
+            try:
+                self._ping(connection)
+            except Exception as e:
+                logging.warning('drop broken connection {}: {}'.format(hex(id(connection)),e))
+                with self._cond:
+                    self._stats['broken']+=1
+                    self._forget(connection)
+                    self._size+=1
+                _close(connection)
+                connection=None
+        if connection is None:
+            try:
+                connection=self._connect()
+            except BaseException:
+                with self._cond:
+                    self._size-=1
+                    self._in_use-=1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._opened[id(connection)]=time()
+                self._stats['opened']+=1
+            logging.info('open connection {}'.format(hex(id(connection))))
+        return connection
+
+    def release(self,connection):
+        try:
+            _reset(connection)
+            broken=False
+        except Exception as e:
+            logging.warning('drop connection {} failing to reset: {}'.format(hex(id(connection)),e))
+            broken=True
+        closing=[]
+        now=time()
+        with self._cond:
+            self._in_use-=1
+            opened=self._opened.get(id(connection))
+            if opened is None:
+                # checked out before a fork
+                closing.append(connection)
+            elif broken or now-opened>=self.max_age:
+                self._stats['broken']+=broken
+                self._forget(connection)
+                closing.append(connection)
+            else:
+                self._idle.append([connection,opened,now])
+            while self._idle and self._size>self.min_size and now-self._idle[0][2]>self.max_idle:
+                idle=self._idle.pop(0)[0]
+                self._forget(idle)
+                closing.append(idle)
+            self._cond.notify()
+        for c in closing:
+            logging.info('close connection {}'.format(hex(id(c))))
+            _close(c)
+
+    def _forget(self,connection):
+        # called with the lock held
+        self._opened.pop(id(connection),None)
+        self._size-=1
+        self._stats['closed']+=1
+
+    def stats(self):
+        with self._cond:
+            stats=dict(self._stats,size=self._size,in_use=self._in_use,idle=len(self._idle),
+                       max_size=self.max_size)
+        stats['utilisation']=stats['in_use']/self.max_size
+        return stats
+
+    def collect(self):
+        '''
+        Prometheus lines of the pool, for metrics.MetricsRegistry.add_collector.
+        '''
+        stats=self.stats()
+        lines=[]
+        for name,kind,help,value in (
+                ('db_pool_connections','gauge','Open connections of the pool.',stats['size']),
+                ('db_pool_connections_in_use','gauge','Connections checked out.',stats['in_use']),
+                ('db_pool_connections_max','gauge','Maximum size of the pool.',stats['max_size']),
+                ('db_pool_checkouts_total','counter','Connections checked out.',stats['checkouts']),
+                ('db_pool_waits_total','counter','Checkouts that waited for a connection.',stats['waits']),
+                ('db_pool_wait_seconds_total','counter','Time spent waiting for a connection.',stats['wait_seconds']),
+                ('db_pool_timeouts_total','counter','Checkouts that timed out.',stats['timeouts']),
+                ('db_pool_opened_total','counter','Connections opened.',stats['opened']),
+                ('db_pool_closed_total','counter','Connections closed.',stats['closed'])):
+            lines.append('# HELP {} {}'.format(name,help))
+            lines.append('# TYPE {} {}'.format(name,kind))
+            lines.append('{} {}'.format(name,value))
+        return lines
 
 
 class _Engine:
-    def __init__(self,connect):
+    def __init__(self,connect,paramstyle='format',ping=None,pool=None):
         self._connect=connect
+        self.paramstyle=paramstyle
+        self.pool=_Pool(connect,ping,**(pool or {}))
 
     def connect(self):
         return self._connect()
 
 engine=None
 
+def pool_stats():
+    return engine.pool.stats() if engine is not None else {}
 
-def create_engine(user,passwd,database,host='127.0.0.1',port=3306,**kwargs):
-    import mysql.connector
+def _after_fork():
+    if engine is not None:
+        engine.pool.after_fork()
+
+if hasattr(os,'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def create_engine(user,passwd,database,host='127.0.0.1',port=3306,pool=None,**kwargs):
+    '''
+    :param pool: options of the connection pool, min_size, max_size, timeout,
+                 max_idle, max_age and ping_after
+    '''
     global engine
     if engine is not None:
         raise DBError('Engine has been initialized')
@@ -64,30 +273,79 @@ def create_engine(user,passwd,database,host='127.0.0.1',port=3306,**kwargs):
     defaults=dict(use_unicode=True,charset='utf8',collation='utf8_general_ci',autocommit=False)
     params.update(defaults,**kwargs)
     params['buffered']=True
-    engine=_Engine(lambda:mysql.connector.connect(**params))
+
+    def connect():
+        # mysql.connector is imported by the first connection, not at startup
+        import mysql.connector
+        return mysql.connector.connect(**params)
+
+    engine=_Engine(connect,ping=lambda c:c.ping(),pool=pool)
     logging.info("Init mysql engine {} ok".format(hex(id(engine))))
 
 
-class _DbContex(threading.local):
+def create_sqlite_engine(database,pool=None,**kwargs):
+    '''
+    A sqlite3 engine standing in for MySQL, e.g. in benchmarks. The SQL of
+    the models runs unchanged, '?' is already the sqlite placeholder.
+    '''
+    import sqlite3
+    global engine
+    if engine is not None:
+        raise DBError('Engine has been initialized')
+    params=dict(check_same_thread=False)
+    params.update(kwargs)
+    engine=_Engine(lambda:sqlite3.connect(database,**params),paramstyle='qmark',
+                   ping=lambda c:c.execute('select 1'),pool=pool)
+    logging.info("Init sqlite engine {} ok".format(hex(id(engine))))
+
+
+class _DbState:
     def __init__(self):
         self.connection=None
         self.transactions=0
 
+_db_state=contextvars.ContextVar('transwarp_db_ctx',default=None)
+
+class _DbContex:
+    """
+    Connection and transaction depth of the current context. The state lives
+    in a ContextVar, so each thread and each asyncio task has its own.
+    """
+    def _state(self):
+        state=_db_state.get()
+        if state is None:
+            state=_DbState()
+            _db_state.set(state)
+        return state
+
+    @property
+    def connection(self):
+        return self._state().connection
+
+    @property
+    def transactions(self):
+        return self._state().transactions
+
+    @transactions.setter
+    def transactions(self,value):
+        self._state().transactions=value
+
     def is_init(self):
         return not self.connection is None
 
     def init(self):
-        self.connection=_LazyConnection()
-        self.transactions=0
+        state=_DbState()
+        state.connection=_LazyConnection()
+        _db_state.set(state)
 
     def cleanup(self):
         self.connection.cleanup()
-        self.connection=None
+        _db_state.set(None)
 
     def cursor(self):
         return self.connection.cursor()
 
-# create a threading local object which will be share by multiple threads
+# a context local object which will be shared by multiple threads and tasks
 # without caring about lock problem
 _db_ctx=_DbContex()
 
@@ -121,8 +379,10 @@ def with_connection(func):
 def _select(sql,first,*args):
     global _db_ctx
     cursor=None
-    sql=sql.replace('?','%s')
+    if engine.paramstyle!='qmark':
+        sql=sql.replace('?','%s')
     logging.info('SQL {},ARGS:{}'.format(sql,args))
+    start=perf_counter()
     try:
         cursor=_db_ctx.connection.cursor()
         cursor.execute(sql,args)
@@ -137,6 +397,8 @@ def _select(sql,first,*args):
     finally:
         if cursor:
             cursor.close()
+        if _statement_listeners:
+            _notify_statement(sql,start)
 
 
 @with_connection
@@ -158,8 +420,10 @@ def select(sql,*args):
 def _update(sql,*args):
     global _db_ctx
     cursor=None
-    sql=sql.replace('?','%s')
+    if engine.paramstyle!='qmark':
+        sql=sql.replace('?','%s')
     logging.info('SQL: {} ARGS:{}'.format(sql,args))
+    start=perf_counter()
     try:
         cursor=_db_ctx.connection.cursor()
         cursor.execute(sql,args)
@@ -171,6 +435,8 @@ def _update(sql,*args):
     finally:
         if cursor:
             cursor.close()
+        if _statement_listeners:
+            _notify_statement(sql,start)
 
 
 def insert(table_name,**kwargs):
@@ -98,6 +98,8 @@ class VersionField(Field):
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+_events = frozenset(['post_insert', 'post_update', 'post_delete'])
+
 
 def _gen_sql(table_name, mappings):
     pk = None
@@ -128,14 +130,14 @@ class ModelMetaclass(type):
         else:
             logging.warning('Redefine class: {}'.format(clsname))
 
-        logging.info('Scan O-R Mapping {}...'.format(clsname))
+        logging.debug('Scan O-R Mapping {}...'.format(clsname))
         mappings = dict()
         primary_key = None
         for k, v in ns.items():
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
-                logging.info('Found Mapping {} => {}'.format(k, v))
+                logging.debug('Found Mapping {} => {}'.format(k, v))
                 if v.primary_key:
                     if primary_key:
                         raise TypeError('Can\'t define more than \
@@ -157,6 +159,7 @@ class ModelMetaclass(type):
         ns['__mappings__'] = mappings
         ns['__primary_key__'] = primary_key
         ns['__sql__'] = lambda self: _gen_sql(ns['__table__'], mappings)
+        ns['__listeners__'] = {}
         for trigger in _triggers:
             if trigger not in ns:
                 ns[trigger] = None
@@ -176,6 +179,20 @@ class Model(dict, metaclass=ModelMetaclass):
     def __setattr__(self, key, value):
         self[key] = value
 
+    @classmethod
+    def add_listener(cls, event, fn):
+        """
+        Call fn(instance) after an instance of this model is inserted, updated
+        or deleted, event is 'post_insert', 'post_update' or 'post_delete'.
+        """
+        if event not in _events:
+            raise ValueError('unknown model event {}'.format(event))
+        cls.__listeners__.setdefault(event, []).append(fn)
+
+    def _notify(self, event):
+        for fn in self.__listeners__.get(event, ()):
+            fn(self)
+
     @classmethod
     def get(cls, pk):
         d = db.select_one('select * from {} where {}=?'.format(cls.__table__, cls.__primary_key__.name), pk)
@@ -215,6 +232,7 @@ class Model(dict, metaclass=ModelMetaclass):
                 params[v.name] = getattr(self, k)
         print(params)
         db.insert(self.__table__, **params)
+        self._notify('post_insert')
         return self
 
     def update(self):
@@ -234,6 +252,7 @@ class Model(dict, metaclass=ModelMetaclass):
         args.append(getattr(self, pk))
         # print('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
         db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        self._notify('post_update')
         return self
 
     def delete(self):
@@ -242,6 +261,7 @@ class Model(dict, metaclass=ModelMetaclass):
         args = (getattr(self, pk),)
         # print('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
         db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        self._notify('post_delete')
         return self
 
 
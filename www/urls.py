@@ -3,12 +3,14 @@
 
 __author__ = 'Henry Wang'
 
-import re, hashlib, time
-from web import get, view, ctx, post, interceptor,seeother,notfound
+import re, hashlib, time, threading
+from collections import OrderedDict
+from web import get, view, ctx, post, interceptor, no_interceptor, seeother, notfound, cached, page_cache, \
+    etag, make_etag
 from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from models import User, Blog, Comment
 from config import configs
-import markdown2
+import metrics
 
 _COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
@@ -26,6 +28,12 @@ def _get_page_index():
         pass
     return page_index
 
+def _user_variant():
+    user = ctx.request.user
+    if user is None:
+        return 'anonymous'
+    return '{}:{}'.format('admin' if user.admin else 'user', user.id)
+
 def _get_blogs_by_page():
     total = Blog.count_all()
     page= Page(total,_get_page_index())
@@ -34,6 +42,7 @@ def _get_blogs_by_page():
 
 
 
+@no_interceptor
 @api
 @get('/api/users')
 def api_get_users():
@@ -43,6 +52,7 @@ def api_get_users():
     return dict(users=users)
 
 
+@no_interceptor
 @api
 @post('/api/users')
 def register_user():
@@ -67,12 +77,14 @@ def register_user():
     return user
 
 
+@no_interceptor
 @view('register.html')
 @get('/register')
 def register():
     return dict()
 
 
+@no_interceptor
 @view('signin.html')
 @get('/signin')
 def signin():
@@ -85,7 +97,92 @@ def make_signed_cookie(id, password, max_age):
     L = [id, expires, hashlib.md5('{}-{}-{}-{}'.format(id, password, expires, _COOKIE_KEY).encode('utf8')).hexdigest()]
     return '-'.join(L)
 
+class _UserCache:
+    """
+    Verified session cookie -> user, so signed-in requests skip the query
+    and the md5. Entries live ttl seconds at most and never past the expiry
+    signed into the cookie, the least recently used go past max_entries.
+    Every cached cookie of a user is dropped when the user is updated or
+    deleted through the ORM, but only in the process that made the change:
+    under the prefork server the other workers keep accepting the old cookie
+    with the old rights for up to ttl seconds, so keep ttl short.
+
+    Callers get their own copy of the cached user and may change it.
+    """
+
+    def __init__(self, max_entries=10000, ttl=10):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # bumped by invalidate(), a user read before that is not cached after it
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, cookie):
+        with self._lock:
+            entry = self._entries.get(cookie)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(cookie)
+                    self.hits += 1
+                    user = entry[1]
+                    return user.__class__(**user)
+                self._remove(cookie)
+            self.misses += 1
+            return None
+
+    def put(self, cookie, user, expires, generation):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            if cookie in self._entries:
+                self._remove(cookie)
+            self._entries[cookie] = (min(expires, time.time() + self.ttl), user.__class__(**user))
+            self._by_user.setdefault(user.id, set()).add(cookie)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.generation += 1
+            for cookie in self._by_user.pop(user_id, ()):
+                del self._entries[cookie]
+
+    def _remove(self, cookie):
+        expires, user = self._entries.pop(cookie)
+        cookies = self._by_user[user.id]
+        cookies.discard(cookie)
+        if not cookies:
+            del self._by_user[user.id]
+
+    def collect(self):
+        return ['# HELP user_cache_hits_total Signed-in requests served from the user cache.',
+                '# TYPE user_cache_hits_total counter',
+                'user_cache_hits_total {}'.format(self.hits),
+                '# HELP user_cache_misses_total Signed-in requests that loaded the user.',
+                '# TYPE user_cache_misses_total counter',
+                'user_cache_misses_total {}'.format(self.misses),
+                '# HELP user_cache_entries Cookies in the user cache.',
+                '# TYPE user_cache_entries gauge',
+                'user_cache_entries {}'.format(len(self._entries))]
+
+
+_user_cache = _UserCache(**configs.user_cache)
+User.add_listener('post_update', lambda user: _user_cache.invalidate(user.id))
+User.add_listener('post_delete', lambda user: _user_cache.invalidate(user.id))
+metrics.registry.add_collector(_user_cache.collect)
+
+
 def parse_signed_cookie(cookie_str):
+    user = _user_cache.get(cookie_str)
+    if user is not None:
+        return user
+    generation = _user_cache.generation
     try:
         L=cookie_str.split('-')
         if len(L) != 3:
@@ -98,10 +195,12 @@ def parse_signed_cookie(cookie_str):
             return None
         if md5 != hashlib.md5('{}-{}-{}-{}'.format(id, user.password, expires, _COOKIE_KEY).encode('utf8')).hexdigest():
             return None
-        return user
     except Exception as e:
         return None
+    _user_cache.put(cookie_str, user, int(expires), generation)
+    return user
 
+@no_interceptor
 @api
 @post('/api/authenticate')
 def authenticate():
@@ -114,7 +213,7 @@ def authenticate():
         raise APIError('auth:failed','email','Invalid email.')
     elif user.password != password:
         raise APIError('auth:failed','password','Invalid password.')
-    max_age = 604800 if remember == 'true' else None
+    max_age = 604800 if remember in (True, 'true') else None
     cookie = make_signed_cookie(user.id, user.password, max_age)
     ctx.response.set_cookie(_COOKIE_NAME,cookie)
     return user
@@ -182,6 +281,7 @@ def manage_users():
 
 
 
+@no_interceptor
 @api
 @get('/api/comments')
 def api_get_comments():
@@ -204,6 +304,7 @@ def api_create_blog_comment(blog_id):
         raise APIValueError('content')
     c = Comment(blog_id=blog_id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
     c.insert()
+    page_cache.invalidate('/blog/{}'.format(blog_id))
     return dict(comment=c)
 
 
@@ -215,8 +316,10 @@ def api_delete_comment(comment_id):
     if comment is None:
         raise APIResourceNotFoundError('Comment')
     comment.delete()
+    page_cache.invalidate('/blog/{}'.format(comment.blog_id))
     return dict(id=comment_id)
 
+@no_interceptor
 @api
 @get('/api/users')
 def api_get_users():
@@ -227,16 +330,19 @@ def api_get_users():
         u.password= '******'
     return dict(users=users,page=page)
 
+@no_interceptor
 @api
 @get('/api/blogs')
 def api_get_blogs():
     format= ctx.request.get('format','')
     blogs,page = _get_blogs_by_page()
     if format=='html':
+        import markdown2
         for blog in blogs:
-            blog.content = markdown2.mardown(blog.content)
+            blog.content = markdown2.markdown(blog.content)
     return dict(blogs=blogs,page=page)
 
+@no_interceptor
 @api
 @get('/api/blogs/:blog_id')
 def api_get_blog(blog_id):
@@ -263,6 +369,7 @@ def api_create_blog():
     user=ctx.request.user
     blog = Blog(user_id=user.id,user_name=user.name,name=name,summary=summary,content=content)
     blog.insert()
+    page_cache.invalidate('/')
     return blog
 
 @api
@@ -286,6 +393,7 @@ def api_update_blog(blog_id):
     blog.summary=summary
     blog.content = content
     blog.update()
+    page_cache.invalidate('/', '/blog/{}'.format(blog_id))
 
 @api
 @post('/api/blogs/:blog_id/delete')
@@ -295,28 +403,60 @@ def api_delete_blog(blog_id):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     blog.delete()
+    page_cache.invalidate('/', '/blog/{}'.format(blog_id))
     return dict(id=blog_id)
 
 
 
+def _minute():
+    # pages show relative dates like '5分钟前', validators change every
+    # minute so a 304 never keeps them stale for longer than the page cache
+    return int(time.time() // 60)
+
+
+@cached(variant=_user_variant)
 @view('blogs.html')
 @get('/')
 def index():
     blogs, page = _get_blogs_by_page()
+    ctx.response.etag = make_etag(_user_variant(), page.page_index, page.page_count, _minute(),
+                                  [(b.id, b.name, b.summary, b.created_at) for b in blogs])
     return dict(page=page, blogs=blogs, user=ctx.request.user)
 
 
+_BLOG_COMMENTS = 1000
+
+
+def _blog_parts(blog, count, latest):
+    # what the validator and the handler both build the ETag of blog.html from
+    return _user_variant(), _minute(), blog.name, blog.summary, blog.content, count, latest
+
+
+def _blog_validator(blog_id):
+    blog = Blog.get(blog_id)
+    if blog is None:
+        return None
+    count = min(Comment.count_by('where blog_id=?', blog_id), _BLOG_COMMENTS)
+    latest = Comment.find_first('where blog_id=? order by created_at desc limit 1', blog_id)
+    return _blog_parts(blog, count, latest.created_at if latest else None)
+
+
+@cached(variant=_user_variant)
+@etag(_blog_validator)
 @view('blog.html')
 @get('/blog/:blog_id')
 def blog(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise notfound()
+    comments = Comment.find_by('where blog_id=? order by created_at desc limit {}'.format(_BLOG_COMMENTS), blog_id)
+    ctx.response.etag = make_etag(_blog_parts(blog, len(comments), comments[0].created_at if comments else None))
+    import markdown2
     blog.html_content = markdown2.markdown(blog.content)
-    comments = Comment.find_by('where blog_id=? order by created_at desc limit 1000', blog_id)
     return dict(blog=blog, comments=comments, user=ctx.request.user)
 
 
+@no_interceptor
 @get('/signout')
 def signout():
     ctx.response.delete_cookie(_COOKIE_NAME)
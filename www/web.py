@@ -3,21 +3,55 @@
 
 __author__ = 'Henry Wang'
 
-import cgi
 from nameddict import Nameddict
+from formparser import FormParser, FormError, BodyTooLargeError
 import urllib.parse
 from http_data import *
 import datetime
 from utc import UTC
 import threading
-import os, mimetypes, logging, sys
+import contextvars
+from collections import OrderedDict
+import os, mimetypes, logging, sys, stat, time
+import gzip, hashlib, itertools, tempfile, zlib
 import types
 import traceback
 from io import StringIO
-from functools import wraps
-from types import GeneratorType
+from functools import partial, wraps
+from email.utils import formatdate, parsedate_to_datetime
 
-ctx = threading.local()
+_ctx_var = contextvars.ContextVar('transwarp_web_ctx', default=None)
+
+
+class _Context:
+    """
+    Attribute namespace stored in a contextvars.ContextVar, so every thread
+    and every asyncio task sees its own application, request and response.
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        d = _ctx_var.get()
+        if d is None or name not in d:
+            raise AttributeError('ctx has no attribute {}'.format(name))
+        return d[name]
+
+    def __setattr__(self, name, value):
+        d = _ctx_var.get()
+        if d is None:
+            d = {}
+            _ctx_var.set(d)
+        d[name] = value
+
+    def __delattr__(self, name):
+        d = _ctx_var.get()
+        if d is None or name not in d:
+            raise AttributeError('ctx has no attribute {}'.format(name))
+        del d[name]
+
+
+ctx = _Context()
 
 UTC_ZERO = UTC('+00:00')
 
@@ -144,6 +178,7 @@ class Route:
         self.is_static = _re_route.search(self.path) is None
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
+        self.no_interceptor = getattr(func, '__no_interceptor__', False)
         self.func = func
 
     def match(self, url):
@@ -163,121 +198,633 @@ class Route:
     __repr__ = __str__
 
 
-def _static_file_generator(fpath):
-    block_size = 8192
+class _Node:
+    __slots__ = ('literals', 'var', 'patterns', 'target')
+
+    def __init__(self):
+        self.literals = {}
+        self.var = None
+        self.patterns = []
+        self.target = None
+
+
+class _Dispatcher:
+    """
+    Dispatch a path to a dynamic route through a trie of path segments.
+
+    A literal segment is looked up in a dict, a ':var' segment matches any
+    non-empty segment and a segment mixing both, like ':name.html', is
+    matched by its own regex. Literal segments are tried before variables,
+    so the cost of a lookup depends on the depth of the path and not on the
+    number of routes. Routes of the same shape match in registration order.
+    Routes that are not made of segments, like StaticFileRoute, are tried
+    in order after the trie. wrap, if given, maps each route to the
+    callable returned in its place.
+    """
+
+    def __init__(self, routes, wrap=None):
+        self._root = _Node()
+        self._fallback = []
+        for route in routes:
+            target = wrap(route) if wrap else route
+            if not isinstance(route, Route):
+                self._fallback.append((route.route, target))
+                continue
+            node = self._root
+            for segment in route.path[1:].split('/'):
+                node = self._child(node, segment)
+            if node.target is None:
+                node.target = target
+
+    @staticmethod
+    def _child(node, segment):
+        if _re_route.search(segment) is None:
+            return node.literals.setdefault(segment, _Node())
+        if _re_route.fullmatch(segment):
+            if node.var is None:
+                node.var = _Node()
+            return node.var
+        pattern = _build_regex(segment)
+        for regex, child in node.patterns:
+            if regex.pattern == pattern:
+                return child
+        child = _Node()
+        node.patterns.append((re.compile(pattern), child))
+        return child
+
+    def match(self, url):
+        if url.startswith('/'):
+            args = []
+            target = self._walk(self._root, url[1:].split('/'), 0, args)
+            if target is not None:
+                return target, tuple(args)
+        for regex, target in self._fallback:
+            m = regex.match(url)
+            if m is not None:
+                return target, m.groups()
+        return None, None
+
+    def _walk(self, node, segments, i, args):
+        if i == len(segments):
+            return node.target
+        segment = segments[i]
+        child = node.literals.get(segment)
+        if child is not None:
+            target = self._walk(child, segments, i + 1, args)
+            if target is not None:
+                return target
+        if node.var is not None and segment:
+            args.append(segment)
+            target = self._walk(node.var, segments, i + 1, args)
+            if target is not None:
+                return target
+            args.pop()
+        for regex, child in node.patterns:
+            m = regex.match(segment)
+            if m is not None:
+                groups = m.groups()
+                args.extend(groups)
+                target = self._walk(child, segments, i + 1, args)
+                if target is not None:
+                    return target
+                del args[len(args) - len(groups):]
+        return None
+
+
+def _static_file_generator(fpath, offset=0, length=None, block_size=65536):
     with open(fpath, 'rb') as f:
-        block = f.read(block_size)
-        while block:
+        if offset:
+            f.seek(offset)
+        while length is None or length > 0:
+            block = f.read(block_size if length is None else min(block_size, length))
+            if not block:
+                break
+            if length is not None:
+                length -= len(block)
             yield block
-            block = f.read(block_size)
+
+
+def _http_date(t):
+    return formatdate(t, usegmt=True)
+
+
+def _parse_http_date(s):
+    try:
+        return parsedate_to_datetime(s).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    weak = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == weak:
+            return True
+    return False
+
+
+def _parse_range(header, size):
+    """
+    Parse a single ``bytes=`` range. Returns (start, end) inclusive, None when
+    the header should be ignored and False when the range is unsatisfiable.
+    """
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+for _type, _ext in (('font/ttf', '.ttf'), ('font/otf', '.otf'), ('font/woff', '.woff'), ('font/woff2', '.woff2'),
+                    ('application/vnd.ms-fontobject', '.eot')):
+    mimetypes.add_type(_type, _ext)
+
+
+class _StaticFile:
+    def __init__(self, fpath, st):
+        self.path = fpath
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.etag = '"{:x}-{:x}"'.format(int(st.st_mtime * 1000), st.st_size)
+        self.last_modified = _http_date(st.st_mtime)
+        fext = os.path.splitext(fpath)[1]
+        self.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        self.compressible = self.content_type.startswith(_COMPRESSIBLE_TYPES)
+        self.variants = {}
+        self.checked = 0
+
+    def digest(self):
+        if not hasattr(self, '_digest'):
+            h = hashlib.sha1()
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    h.update(block)
+            self._digest = h.hexdigest()
+        return self._digest
+
+
+_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                       'image/svg+xml', 'font/ttf', 'font/otf', 'application/vnd.ms-fontobject')
+
+
+def _import_brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def _parse_accept_encoding(header):
+    accepted = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.lower()] = q
+    return accepted
+
+
+def _private_directory(path):
+    """
+    Create path with mode 0700, or check that an existing one is a directory
+    of the current user nobody else can write to. Files in these directories
+    are loaded as code, served as assets or trusted as session data, so no
+    other local user may plant them.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError('{} must be a directory owned by uid {} with mode 0700'.format(path, os.getuid()))
+    return path
+
+
+class StaticCompressionCache:
+    """
+    Content-addressed store of gzip and brotli copies of static files.
+
+    Compressed copies are named after the sha1 of the original content, so
+    every worker sharing cache_dir reuses them and a changed file never sees
+    a stale copy. They are written on first request or by precompress().
+    """
+
+    _suffixes = {'br': '.br', 'gzip': '.gz'}
+
+    def __init__(self, cache_dir, level=9, min_size=256):
+        self._cache_dir = cache_dir
+        self._level = level
+        self._min_size = min_size
+        self._brotli = _import_brotli()
+        self.encodings = ('br', 'gzip') if self._brotli else ('gzip',)
+        # a planted copy would be served as the asset it is named after
+        _private_directory(cache_dir)
+
+    def _compress(self, data, encoding):
+        if encoding == 'br':
+            return self._brotli.compress(data, quality=min(self._level + 2, 11))
+        return gzip.compress(data, self._level, mtime=0)
+
+    def get(self, f, encoding):
+        """
+        Return (path, size) of the encoded copy of f, or None when the file is
+        too small or does not shrink.
+        """
+        if encoding in f.variants:
+            return f.variants[encoding]
+        variant = None
+        if f.size >= self._min_size:
+            digest = f.digest()
+            path = os.path.join(self._cache_dir, digest[:2], digest + self._suffixes[encoding])
+            try:
+                variant = path, os.stat(path).st_size
+            except OSError:
+                variant = self._write(f, encoding, path)
+        f.variants[encoding] = variant
+        return variant
+
+    def _write(self, f, encoding, path):
+        with open(f.path, 'rb') as fp:
+            data = self._compress(fp.read(), encoding)
+        if len(data) >= f.size:
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+        logging.info('compress {} ({}) {} -> {}'.format(f.path, encoding, f.size, len(data)))
+        return path, len(data)
 
 
 class StaticFileRoute:
-    def __init__(self):
+    """
+    Serve files under document_root/static with validators and byte ranges.
+
+    Stat results and ETags are cached and re-checked at most once every
+    check_interval seconds. Full bodies go through wsgi.file_wrapper when the
+    server offers one, so it can use sendfile. With a cache_dir, compressible
+    files are sent as precompressed gzip/brotli copies chosen by
+    Accept-Encoding.
+    """
+
+    def __init__(self, max_age=0, check_interval=1.0, block_size=65536, cache_dir=None, level=9):
         self.method = 'GET'
         self.is_static = False
-        self.route = re.compile(r'^/static/(.+)$')
+        self.no_interceptor = True
+        self.path = '/static/*'
+        self.route = re.compile(r'^/(static/.+)$')
+        self._max_age = max_age
+        self._check_interval = check_interval
+        self._block_size = block_size
+        self._files = {}
+        self._compression = StaticCompressionCache(cache_dir, level) if cache_dir else None
+
+    def precompress(self, static_dir):
+        """
+        Build the compressed copies of every file under static_dir ahead of time.
+        """
+        if self._compression is None:
+            return
+        for dirpath, dirnames, filenames in os.walk(static_dir):
+            for name in filenames:
+                f = self._stat(os.path.join(dirpath, name))
+                if f is not None and f.compressible:
+                    for encoding in self._compression.encodings:
+                        self._compression.get(f, encoding)
+
+    def _select(self, environ, f):
+        """
+        Pick the representation of f to send: (path, size, etag, encoding).
+        """
+        if self._compression is None or not f.compressible:
+            return f.path, f.size, f.etag, None
+        accepted = _parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        best = None
+        for encoding in self._compression.encodings:
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if q > 0 and (best is None or q > best[0]):
+                best = q, encoding
+        if best is not None:
+            variant = self._compression.get(f, best[1])
+            if variant is not None:
+                return variant[0], variant[1], '{}-{}"'.format(f.etag[:-1], best[1]), best[1]
+        return f.path, f.size, f.etag, None
 
     def match(self, url):
         if url.startswith('/static/'):
             return url[1:],
         return None
 
+    def _stat(self, fpath):
+        now = time.time()
+        f = self._files.get(fpath)
+        if f is not None and now - f.checked < self._check_interval:
+            return f
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            self._files.pop(fpath, None)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if f is None or f.mtime != st.st_mtime or f.size != st.st_size:
+            f = _StaticFile(fpath, st)
+        f.checked = now
+        self._files[fpath] = f
+        return f
+
+    def _not_modified(self, environ, etag, mtime):
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            return _etag_matches(if_none_match, etag)
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            t = _parse_http_date(if_modified_since)
+            return t is not None and int(mtime) <= t
+        return False
+
     def __call__(self, *args, **kwargs):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        root = os.path.join(os.path.abspath(ctx.application.document_root), 'static')
+        fpath = os.path.normpath(os.path.join(root, args[0][7:]))
+        if not fpath.startswith(root + os.sep):
             raise notfound()
-        fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
-        return _static_file_generator(fpath)
+        f = self._stat(fpath)
+        if f is None:
+            raise notfound()
+        environ = ctx.request.environ
+        response = ctx.response
+        fpath, size, etag, encoding = self._select(environ, f)
+        response.content_type = f.content_type
+        response.set_header('ETag', etag)
+        response.set_header('Last-Modified', f.last_modified)
+        response.set_header('Accept-Ranges', 'bytes')
+        if self._compression is not None and f.compressible:
+            response.set_header('Vary', 'Accept-Encoding')
+        if encoding:
+            response.set_header('Content-Encoding', encoding)
+        if self._max_age:
+            response.set_header('Cache-Control', 'public, max-age={}'.format(self._max_age))
+        if self._not_modified(environ, etag, f.mtime):
+            response.status = 304
+            response.content_type = None
+            response.unset_header('Content-Encoding')
+            return []
+        r = None
+        range_header = environ.get('HTTP_RANGE')
+        if range_header and environ.get('HTTP_IF_RANGE', etag) in (etag, f.last_modified):
+            r = _parse_range(range_header, size)
+        if r is False:
+            response.status = 416
+            response.set_header('Content-Range', 'bytes */{}'.format(size))
+            response.content_type = None
+            response.unset_header('Content-Encoding')
+            return []
+        if r is not None:
+            start, end = r
+            response.status = 206
+            response.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+            response.content_length = end - start + 1
+            return _static_file_generator(fpath, start, end - start + 1, self._block_size)
+        response.content_length = size
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(open(fpath, 'rb'), self._block_size)
+        return _static_file_generator(fpath, block_size=self._block_size)
+
+
+_default_form_parser = FormParser()
+
+
+class _Repeated(list):
+    """
+    The values of a field given more than once, unlike a JSON array, which is
+    a single value.
+    """
 
 
 class Request:
     """
     Request Object for obtaining all http request information
+
+    Everything derived from the environ is computed on first use and kept in
+    a slot, so a request only pays for what its handler looks at.
     """
 
-    def __init__(self, environ):
+    __slots__ = ('_environ', '_form_parser', '_raw_input', '_body', '_json', '_headers', '_cookies',
+                 '_path_info', '_session_store', '_session', 'user')
+
+    def __init__(self, environ, form_parser=None, session_store=None):
         self._environ = environ
+        self._form_parser = form_parser or _default_form_parser
+        self._raw_input = self._body = self._json = None
+        self._headers = self._cookies = self._path_info = None
+        self._session_store = session_store
+        self._session = None
+        self.user = None
 
     def _parse_input(self):
-        params = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ, keep_blank_values=1)
-        return {key: params[key].value for key in params}
+        try:
+            document = self.json if self._form_parser.is_json(self._environ) else None
+            pairs = self._form_parser.parse(self._environ)
+        except BodyTooLargeError:
+            raise HttpError(413)
+        except FormError:
+            raise badrequest()
+        params = {}
+        for k, v in pairs:
+            if k not in params:
+                params[k] = v
+            elif isinstance(params[k], _Repeated):
+                params[k].append(v)
+            else:
+                params[k] = _Repeated((params[k], v))
+        if document is not None:
+            if not isinstance(document, dict):
+                raise badrequest()
+            # the top level keys of a JSON body win over the query string
+            params.update(document)
+        return params
 
     def _get_raw_input(self):
-        if not hasattr(self, '_raw_input'):
+        if self._raw_input is None:
             self._raw_input = self._parse_input()
         return self._raw_input
 
     def __getitem__(self, key):
         r = self._get_raw_input()[key]
-        if isinstance(r, list):
+        if isinstance(r, _Repeated):
             return r[0]
         return r
 
     def get(self, key, default=None):
         r = self._get_raw_input().get(key, default)
-        if isinstance(r, list):
+        if isinstance(r, _Repeated):
             return r[0]
         return r
 
     def gets(self, key):
         r = self._get_raw_input()[key]
-        return r if isinstance(r, list) else [r]
+        return list(r) if isinstance(r, _Repeated) else [r]
 
     def input(self, **kwargs):
         kwargs = Nameddict(**kwargs)
         for k, v in self._get_raw_input().items():
-            kwargs[k] = v[0] if isinstance(v, list) else v
+            kwargs[k] = v[0] if isinstance(v, _Repeated) else v
         return kwargs
 
     def get_body(self):
-        fp = self._environ['wsgi.input']
-        fp.seek(0)
-        return fp.read()
+        """
+        Read the raw body once. Not available after a form body has been
+        streamed through input().
+        """
+        if self._body is not None:
+            return self._body
+        try:
+            self._body = self._form_parser.read_body(self._environ)
+        except BodyTooLargeError:
+            raise HttpError(413)
+        except FormError:
+            raise badrequest()
+        return self._body
+
+    @property
+    def json(self):
+        """
+        The decoded JSON body, or None when the body is empty.
+        """
+        if self._json is not None:
+            return self._json
+        try:
+            self._json = self._form_parser.parse_json(self.get_body())
+        except FormError:
+            raise badrequest()
+        return self._json
 
     def _get_headers(self):
-        if not hasattr(self, '_headers'):
-            headers = {}
-            for k, v in self._environ.items():
-                if k.startswith('HTTP_'):
-                    headers[k[5:].replace('_', '-').upper()] = v
-            self._headers = headers
-        return self._headers
+        if self._headers is not None:
+            return self._headers
+        headers = Nameddict()
+        for k, v in self._environ.items():
+            if k.startswith('HTTP_'):
+                headers[k[5:].replace('_', '-').upper()] = v
+        self._headers = headers
+        return headers
 
     def _get_cookies(self):
-        if not hasattr(self, '_cookies'):
-            cookies = {}
-            cookie_str = self._environ.get('HTTP_COOKIE')
-            if cookie_str:
-                for c in cookie_str.split(';'):
-                    pos = c.find('=')
-                    if pos > 0:
-                        cookies[c[:pos].strip()] = _unquote(c[pos + 1:])
-            self._cookies = cookies
-        return self._cookies
-
-    document_root = property(lambda self: self._environ.get('document_root'.upper(), ''))
-    query_string = property(lambda self: self._environ.get('query_string'.upper(), ''))
+        if self._cookies is not None:
+            return self._cookies
+        cookies = Nameddict()
+        cookie_str = self._environ.get('HTTP_COOKIE')
+        if cookie_str:
+            for c in cookie_str.split(';'):
+                pos = c.find('=')
+                if pos > 0:
+                    cookies[c[:pos].strip()] = _unquote(c[pos + 1:])
+        self._cookies = cookies
+        return cookies
+
+    def header(self, name, default=None):
+        """
+        Look up one header straight in the environ, without building the
+        headers dict.
+        """
+        key = name.upper().replace('-', '_')
+        if key in _CGI_HEADERS:
+            return self._environ.get(key, default)
+        return self._environ.get('HTTP_' + key, default)
+
+    def cookie(self, name, default=None):
+        return self._get_cookies().get(name, default)
+
+    @property
+    def session(self):
+        """
+        The server-side session.Session of the client, loaded on first use.
+        """
+        if self._session is None:
+            if self._session_store is None:
+                raise RuntimeError('no session store, pass session_store to WSGIApplication')
+            self._session = self._session_store.open(self.cookie(self._session_store.cookie_name))
+        return self._session
+
+    def save_session(self, response):
+        if self._session is not None:
+            self._session_store.save(self._session, response)
+
+    @property
+    def path_info(self):
+        if self._path_info is None:
+            self._path_info = _unquote(self._environ.get('PATH_INFO', ''))
+        return self._path_info
+
+    document_root = property(lambda self: self._environ.get('DOCUMENT_ROOT', ''))
+    query_string = property(lambda self: self._environ.get('QUERY_STRING', ''))
     environ = property(lambda self: self._environ)
-    request_method = property(lambda self: self._environ['request_method'.upper()])
-    path_info = property(lambda self: _unquote(self._environ.get('path_info'.upper(), '')))
-    http_host = property(lambda self: self._environ.get('http_host'.upper(), ''))
-    headers = property(lambda self: Nameddict(**self._get_headers().read))
-    header = property(lambda self, header, default=None: self._get_headers.get(header.upper(), default))
-    cookies = property(lambda self: Nameddict(**self._get_cookies()))
-    cookie = property(lambda self, name, default=None: self._get_cookies().get(name, default))
+    request_method = property(lambda self: self._environ['REQUEST_METHOD'])
+    http_host = property(lambda self: self._environ.get('HTTP_HOST', ''))
+    headers = property(lambda self: self._get_headers())
+    cookies = property(lambda self: self._get_cookies())
+
+
+_CGI_HEADERS = frozenset(['CONTENT_TYPE', 'CONTENT_LENGTH'])
+
+_STATUS_LINES = {code: '{} {}'.format(code, text) for code, text in RESPONSE_STATUSES.items()}
+
+_DEFAULT_CONTENT_TYPE = 'text/html; charset=utf-8'
+
+_DEFAULT_RESPONSE_HEADERS = (('Content-Type', _DEFAULT_CONTENT_TYPE), HEADER_X_POWERED_BY)
 
 
 class Response:
+    """
+    Headers stay None until the first change, so a plain 200 text/html
+    response reuses the precomputed default header tuples.
+    """
+
+    __slots__ = ('_status', '_headers', '_cookies')
+
     def __init__(self):
         self._status = '200 OK'
-        self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+        self._headers = None
+        self._cookies = None
+
+    def _get_headers(self):
+        if self._headers is None:
+            self._headers = {'CONTENT-TYPE': _DEFAULT_CONTENT_TYPE}
+        return self._headers
 
     @property
     def headers(self):
-        L = [(RESPONSE_HEADERS_DICT.get(k, k), v) for k, v in self._headers.items()]
-        if hasattr(self, '_cookies'):
+        if self._headers is None and self._cookies is None:
+            return list(_DEFAULT_RESPONSE_HEADERS)
+        L = [(RESPONSE_HEADERS_DICT.get(k, k), v) for k, v in self._get_headers().items()]
+        if self._cookies:
             for v in self._cookies.values():
                 L.append(('Set-Cookie', v))
         L.append(HEADER_X_POWERED_BY)
@@ -287,26 +834,29 @@ class Response:
         key = name.upper()
         if key not in RESPONSE_HEADERS_DICT:
             key = name
+        if self._headers is None:
+            return _DEFAULT_CONTENT_TYPE if key == 'CONTENT-TYPE' else None
         return self._headers.get(key)
 
     def unset_header(self, name):
         key = name.upper()
         if key not in RESPONSE_HEADERS_DICT:
             key = name
-        if key in self._headers:
-            del self._headers[key]
+        headers = self._get_headers()
+        if key in headers:
+            del headers[key]
 
     def set_header(self, name, value):
         key = name.upper()
         if key not in RESPONSE_HEADERS_DICT:
             key = name
-        self._headers[key] = value
+        self._get_headers()[key] = value
 
     def delete_cookie(self, name):
         self.set_cookie(name, '__deleted__', expires=0)
 
     def set_cookie(self, name, value, max_age=None, expires=None, path='/', domain=None, secure=False, http_only=True):
-        if not hasattr(self, '_cookies'):
+        if self._cookies is None:
             self._cookies = {}
         L = ['{}={}'.format(_quote(name), _quote(value))]
         if expires is not None:
@@ -328,9 +878,8 @@ class Response:
         self._cookies[name] = '; '.join(L)
 
     def unset_cookie(self, name):
-        if hasattr(self, '_cookies'):
-            if name in self._cookies:
-                del self._cookies[name]
+        if self._cookies and name in self._cookies:
+            del self._cookies[name]
 
     @property
     def content_type(self):
@@ -348,6 +897,14 @@ class Response:
     def content_length(self, value):
         self.set_header('CONTENT-LENGTH', str(value)) if value else self.unset_header('CONTENT-LENGTH')
 
+    @property
+    def etag(self):
+        return self.header('ETAG')
+
+    @etag.setter
+    def etag(self, value):
+        self.set_header('ETAG', value) if value else self.unset_header('ETAG')
+
     status_code = property(lambda self: int(self._status[:3]))
 
     @property
@@ -358,11 +915,7 @@ class Response:
     def status(self, value):
         if isinstance(value, int):
             if 100 <= value <= 599:
-                st = RESPONSE_STATUSES.get(value, '')
-                if st:
-                    self._status = '{} {}'.format(value, st)
-                else:
-                    self._status = str(value)
+                self._status = _STATUS_LINES.get(value) or str(value)
         elif isinstance(value, str):
             if RE_RESPONSE_STATUS.search(value):
                 self._status = value
@@ -379,23 +932,204 @@ class Template:
 
 
 class TemplateEngine:
+    streaming = False
+
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
 
+    def stream(self, path, model):
+        """
+        Render the template as an iterable of utf-8 chunks. Used instead of
+        __call__ when streaming is set.
+        """
+        yield self(path, model).encode('utf8')
+
+    def fingerprint(self):
+        """
+        A digest of the template sources, which changes when a deploy changes
+        how pages look.
+        """
+        return ''
+
 
 class Jinja2TemplateEngine(TemplateEngine):
-    def __init__(self, template_dir, **kwargs):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, template_dir, cache_bytecode=False, bytecode_cache_dir=None, stream=False, buffer_size=8192,
+                 **kwargs):
+        """
+        :param cache_bytecode: keep compiled templates on disk, shared by all worker processes
+        :param bytecode_cache_dir: directory of the bytecode cache, private to the user running the
+                                   application; None lets jinja2 use its own per-user directory
+        :param stream: send pages in chunks of about buffer_size characters as they are rendered
+        :param kwargs: options of jinja2.Environment, e.g. auto_reload=False to stop stat()ing
+                       template sources on every lookup
+        """
         if 'autoescape' not in kwargs:
             kwargs['autoescape'] = True
-        self._env = Environment(loader=FileSystemLoader(template_dir), **kwargs)
+        self._template_dir = template_dir
+        self._cache_bytecode = cache_bytecode
+        self._bytecode_cache_dir = bytecode_cache_dir
+        self._options = kwargs
+        self._filters = {}
+        self._jinja_env = None
+        self.streaming = stream
+        self._buffer_size = buffer_size
+
+    @property
+    def _env(self):
+        """
+        The jinja2.Environment, created and jinja2 imported on first use.
+        """
+        env = self._jinja_env
+        if env is None:
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+            options = dict(self._options)
+            if self._cache_bytecode and 'bytecode_cache' not in options:
+                directory = self._bytecode_cache_dir
+                if directory is not None:
+                    _private_directory(directory)
+                options['bytecode_cache'] = FileSystemBytecodeCache(directory)
+            env = Environment(loader=FileSystemLoader(self._template_dir), **options)
+            env.filters.update(self._filters)
+            self._jinja_env = env
+        return env
+
+    def fingerprint(self):
+        h = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(self._template_dir):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                h.update(os.path.relpath(path, self._template_dir).encode('utf8'))
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+        return h.hexdigest()
 
     def add_filter(self, name, fn_filter):
-        self._env.filters[name] = fn_filter
+        self._filters[name] = fn_filter
+        if self._jinja_env is not None:
+            self._jinja_env.filters[name] = fn_filter
+
+    def precompile(self):
+        """
+        Load every template so requests never compile one. Call it after all
+        filters have been added.
+        """
+        names = self._env.list_templates()
+        for name in names:
+            self._env.get_template(name)
+        logging.info('precompiled {} templates'.format(len(names)))
 
     def __call__(self, path, model):
         return self._env.get_template(path).render(**model)
 
+    def stream(self, path, model):
+        # load the template now so a missing one fails before the headers are sent
+        return self._generate(self._env.get_template(path).generate(**model))
+
+    def _generate(self, events):
+        buf = []
+        size = 0
+        for event in events:
+            buf.append(event)
+            size += len(event)
+            if size >= self._buffer_size:
+                yield ''.join(buf).encode('utf8')
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf).encode('utf8')
+
+
+class ResponseCompressor:
+    """
+    Gzip dynamic responses whose content type is in types.
+
+    Only list bodies and streamed generators without Content-Length are
+    compressed; files, wsgi.file_wrapper bodies and other sized streams go
+    out untouched so the server can still sendfile() them. The body is
+    peeked until min_size bytes are buffered; smaller bodies go out
+    untouched. Larger ones are compressed as the body iterable yields and
+    flushed every flush_size bytes of input, so streamed pages still reach
+    the client early without a flush per chunk.
+    """
+
+    def __init__(self, level=6, min_size=1024, flush_size=8192,
+                 types=('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript',
+                        'application/xml')):
+        self._level = level
+        self._min_size = min_size
+        self._flush_size = flush_size
+        self._types = frozenset(types)
+
+    def _acceptable(self, environ, response):
+        if response.status_code != 200 or response.header('Content-Encoding') or response.header('Content-Range'):
+            return False
+        content_type = (response.content_type or '').partition(';')[0].strip()
+        return content_type in self._types
+
+    def __call__(self, environ, response, body):
+        if not isinstance(body, list) and (not isinstance(body, types.GeneratorType) or
+                                           response.content_length is not None):
+            return body
+        if not self._acceptable(environ, response):
+            return body
+        vary = response.header('Vary')
+        if not vary:
+            response.set_header('Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            response.set_header('Vary', vary + ', Accept-Encoding')
+        accepted = _parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if accepted.get('gzip', accepted.get('*', 0)) <= 0:
+            return body
+        if isinstance(body, list):
+            if sum(map(len, body)) < self._min_size:
+                return body
+            data = gzip.compress(b''.join(body), self._level)
+            self._encoded(response)
+            response.content_length = len(data)
+            return [data]
+        it = iter(body)
+        head = []
+        size = 0
+        for chunk in it:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self._min_size:
+                break
+        else:
+            body.close()
+            return head
+        self._encoded(response)
+        response.content_length = None
+        return self._stream(head, it, body)
+
+    @staticmethod
+    def _encoded(response):
+        """
+        The gzip bytes differ from the identity ones, so a strong ETag of the
+        page becomes weak, which If-None-Match still compares equal.
+        """
+        response.set_header('Content-Encoding', 'gzip')
+        etag = response.etag
+        if etag and not etag.startswith('W/'):
+            response.etag = 'W/' + etag
+
+    def _stream(self, head, it, body):
+        z = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        pending = 0
+        try:
+            for chunk in itertools.chain(head, it):
+                data = z.compress(chunk)
+                pending += len(chunk)
+                if pending >= self._flush_size:
+                    data += z.flush(zlib.Z_SYNC_FLUSH)
+                    pending = 0
+                if data:
+                    yield data
+            yield z.flush()
+        finally:
+            body.close()
+
 
 def _default_error_handler(e, start_response):
     if isinstance(e, HttpError):
@@ -420,6 +1154,215 @@ def view(path):
                 return Template(path, **r)
             raise ValueError('Expected return a dict when using @view decorator')
 
+        wrapper.__web_view__ = path
+        return wrapper
+
+    return decorator
+
+
+# Part of every ETag built by make_etag. It is set by WSGIApplication from the
+# etag_salt option or the fingerprint of the templates, so every worker of a
+# deploy makes the same ETags and a new deploy does not match the pages cached
+# by clients before it.
+_etag_salt = b''
+
+
+def make_etag(*parts):
+    """
+    A strong ETag built from the parts that decide what a page shows, e.g.
+    the ids and timestamps of the rows it renders.
+    """
+    h = hashlib.sha1(_etag_salt)
+    h.update(repr(parts).encode('utf8'))
+    return '"{}"'.format(h.hexdigest())
+
+
+def _not_modified_response(request, response):
+    """
+    Turn the response into a 304 if its ETag matches If-None-Match.
+    """
+    etag = response.etag
+    if etag is None or request.request_method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.header('If-None-Match')
+    if if_none_match is None or not _etag_matches(if_none_match, etag):
+        return False
+    response.status = 304
+    response.content_type = None
+    return True
+
+
+def etag(validator):
+    """
+    Answer conditional GETs of a @view handler before it runs. validator
+    takes the route arguments and returns a cheap summary of what the page
+    shows, or None when it cannot tell. It only runs for requests with
+    If-None-Match, views send no Last-Modified so If-Modified-Since alone
+    cannot be answered. Put it below @cached:
+
+        @cached(variant=_user_variant)
+        @etag(lambda blog_id: (blog_id, latest_comment_time(blog_id)))
+        @view('blog.html')
+        @get('/blog/:blog_id')
+        def blog(blog_id):
+
+    The handler should set ctx.response.etag from the rows it loads, with
+    the same parts, so unconditional requests get an ETag without running
+    the validator. A handler without a validator can do the same, the
+    template is then not rendered for a matching request.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if ctx.request.header('If-None-Match') is None:
+                return func(*args, **kwargs)
+            parts = validator(*args, **kwargs)
+            if parts is not None:
+                response = ctx.response
+                response.etag = make_etag(parts)
+                if _not_modified_response(ctx.request, response):
+                    return None
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _CachedPage:
+    __slots__ = ('expires', 'path', 'headers', 'body')
+
+    def __init__(self, expires, path, headers, body):
+        self.expires = expires
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class PageCache:
+    """
+    LRU cache of rendered pages. Entries expire after their ttl and the least
+    recently used ones are evicted once the bodies exceed max_bytes.
+    """
+
+    entry_overhead = 256
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._paths = {}
+        self._size = 0
+
+    def configure(self, max_bytes=None, ttl=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if ttl is not None:
+            self.ttl = ttl
+        self.clear()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, path, headers, body, ttl=None):
+        size = len(body) + self.entry_overhead
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _CachedPage(time.time() + (ttl or self.ttl), path, headers, body)
+            self._paths.setdefault(path, set()).add(key)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *paths):
+        """
+        Drop every variant and query string of the given paths.
+        """
+        with self._lock:
+            for path in paths:
+                for key in list(self._paths.get(path, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._paths.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.body) + self.entry_overhead
+        keys = self._paths.get(entry.path)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._paths[entry.path]
+
+
+page_cache = PageCache()
+
+
+def cached(ttl=None, variant=None):
+    """
+    Cache the page rendered by a @view handler, put it above @view:
+
+        @cached(ttl=60, variant=lambda: 'anonymous')
+        @view('blogs.html')
+        @get('/')
+        def index():
+
+    The key is the method, path, query string and the result of variant(),
+    which tells apart pages rendered for different users. Pages without an
+    ETag get one from the hash of their body, a matching If-None-Match is
+    answered with 304.
+
+    A cached page is rendered into memory as a whole and never streamed. A
+    variant of None, or a page cache with max_bytes 0, bypasses the cache for
+    that request and leaves the Template to the engine, which streams it when
+    templates are streamed.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            request = ctx.request
+            response = ctx.response
+            v = variant() if variant else ''
+            if v is None or page_cache.max_bytes <= 0:
+                return func(*args, **kwargs)
+            key = (request.request_method, request.path_info, request.query_string, v)
+            entry = page_cache.get(key)
+            if entry is not None:
+                for k, value in entry.headers.items():
+                    response.set_header(k, value)
+                if _not_modified_response(request, response):
+                    return None
+                return entry.body
+            r = func(*args, **kwargs)
+            if not isinstance(r, Template):
+                return r
+            if _not_modified_response(request, response):
+                return None
+            body = ctx.application.template_engine(r.template_name, r.model).encode('utf8')
+            if response.etag is None:
+                response.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if response.status_code == 200 and not response._cookies:
+                page_cache.put(key, request.path_info, dict(response._get_headers()), body, ttl)
+            if _not_modified_response(request, response):
+                return None
+            return body
+
         return wrapper
 
     return decorator
@@ -429,42 +1372,112 @@ RE_INTERCEPTOR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
 RE_INTERCEPTOR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
 
 
-def _build_pattern_fn(pattern):
+def _parse_pattern(pattern):
     m = RE_INTERCEPTOR_STARTS_WITH.search(pattern)
     if m:
-        return lambda p: p.startswith(m.group(1))
+        return 'startswith', m.group(1)
     m = RE_INTERCEPTOR_ENDS_WITH.search(pattern)
     if m:
-        return lambda p: p.endswith(m.group(1))
+        return 'endswith', m.group(1)
     raise ValueError('invalid pattern definition in interceptor')
 
 
+def _build_pattern_fn(pattern):
+    kind, text = _parse_pattern(pattern)
+    if kind == 'startswith':
+        return lambda p: p.startswith(text)
+    return lambda p: p.endswith(text)
+
+
 def interceptor(pattern='/'):
     def decorator(func):
         func.__interceptor__ = _build_pattern_fn(pattern)
+        func.__interceptor_pattern__ = _parse_pattern(pattern)
         return func
     return decorator
 
 
-def _build_interceptor_fn(func, next):
-    def wrapper():
-        if func.__interceptor__(ctx.request.path_info):
-            return func(next)
-        else:
-            return next()
+def no_interceptor(func):
+    """
+    Mark a handler that needs none of the interceptors, e.g. one that never
+    looks at ctx.request.user. Its route skips the interceptor chain.
+    """
+    func.__no_interceptor__ = True
+    return func
+
+
+def no_admission(func):
+    """
+    Keep a handler out of admission control, e.g. an operational endpoint
+    that must answer while the application is overloaded.
+    """
+    func.__no_admission__ = True
+    return func
+
+
+def _pattern_applies(func, route):
+    """
+    Decide from the route path alone whether the pattern of an interceptor
+    matches the paths of the route: True or False, or None when it depends on
+    the values of the route variables and must be checked per request.
+    """
+    if route.is_static:
+        return func.__interceptor__(route.path)
+    kind, text = func.__interceptor_pattern__
+    parts = _re_route.split(route.path)
+    if kind == 'startswith':
+        literal = parts[0]
+        if literal.startswith(text):
+            return True
+        if len(literal) >= len(text) or not text.startswith(literal):
+            return False
+    else:
+        literal = parts[-1]
+        if literal.endswith(text):
+            return True
+        if len(literal) >= len(text) or not text.endswith(literal):
+            return False
+    return None
+
+
+def _build_interceptor_fn(func, next, check):
+    def wrapper(*args):
+        if check and not func.__interceptor__(ctx.request.path_info):
+            return next(*args)
+        return func(partial(next, *args))
 
     return wrapper
 
 
-def _build_interceptor_chain(last_fn, *interceptors):
-    L = list(interceptors)
-    L.reverse()
-    fn = last_fn
-    for f in L:
-        fn = _build_interceptor_fn(f, fn)
+def _build_interceptor_chain(route, *interceptors):
+    """
+    Wrap a route in the interceptors whose patterns can match it, once at
+    startup. The chain takes the route arguments.
+    """
+    if route.no_interceptor:
+        return route
+    fn = route
+    for f in reversed(interceptors):
+        applies = _pattern_applies(f, route)
+        if applies is False:
+            continue
+        fn = _build_interceptor_fn(f, fn, applies is None)
     return fn
 
 
+def _admission_class(route):
+    """
+    Default admission class of route, None when it has no budget.
+    """
+    if isinstance(route, StaticFileRoute):
+        return 'static'
+    if getattr(route.func, '__no_admission__', False):
+        return None
+    if getattr(route.func, '__web_view__', None):
+        return 'view'
+    return 'default'
+
+
 def _load_module(module_name):
     last_dot = module_name.rfind('.')
     if last_dot == -1:
@@ -479,11 +1492,43 @@ class WSGIApplication:
     def __init__(self, document_root=None, **kwargs):
         """
         :param document_root: document root path
-        :param kwargs:
+        :param kwargs: static -- options of StaticFileRoute (plus precompress=True to build the compressed
+                       copies at startup), serve /static/ even when not in debug mode. A relative
+                       cache_dir is under the document root
+                       compression -- options of ResponseCompressor, gzip dynamic responses
+                       form -- options of FormParser, limits of request bodies
+                       page_cache -- max_bytes and ttl of the page cache used by @cached
+                       metrics -- path of the Prometheus endpoint, the addresses (allow, default
+                       loopback) or bearer token allowed to read it, and latency buckets; enables
+                       metrics.RequestMetrics
+                       profiling -- directory, secret, sample_rate and max_files of
+                       profiling.RequestProfiler. A relative directory is under the document root
+                       admission -- budgets of admission.AdmissionController, answer 503 over them
+                       session_store -- options of session.create_store, enables ctx.request.session.
+                       A relative directory is under the document root
+                       etag_salt -- mixed into the ETags of make_etag, e.g. the version of a deploy;
+                       defaults to the fingerprint of the templates
         """
 
         self._running = False
         self._document_root = document_root
+        self._static = kwargs.get('static')
+        self._compression = kwargs.get('compression')
+        self._form_parser = FormParser(**kwargs.get('form', {}))
+        self._metrics = kwargs.get('metrics')
+        self._profiling = kwargs.get('profiling')
+        self._admission = kwargs.get('admission')
+        self._etag_salt = kwargs.get('etag_salt')
+        self._session_store = None
+        if kwargs.get('session_store'):
+            from session import create_store
+            options = dict(kwargs['session_store'])
+            if options.get('directory') and document_root:
+                options['directory'] = os.path.join(document_root, options['directory'])
+            self._session_store = create_store(**options)
+        self._wsgi = None
+        if kwargs.get('page_cache'):
+            page_cache.configure(**kwargs['page_cache'])
 
         self._interceptors = []
         self._template_engine = None
@@ -510,7 +1555,7 @@ class WSGIApplication:
     def add_module(self, mod):
         self._check_out_running()
         m = mod if type(mod) == types.ModuleType else _load_module(mod)
-        logging.info('add module:{}'.format(m.__name__))
+        logging.debug('add module:{}'.format(m.__name__))
         for name in dir(m):
             fn = getattr(m, name)
             if callable(fn) and hasattr(fn, '__web_route__') and hasattr(fn, '__web_method__'):
@@ -529,74 +1574,152 @@ class WSGIApplication:
                 self._get_dynamic.append(route)
             if route.method=='POST':
                 self._post_dynamic.append(route)
-        logging.info('add route: {!s}'.format(route))
+        logging.debug('add route: {!s}'.format(route))
 
     def add_interceptor(self, func):
         self._check_out_running()
         self._interceptors.append(func)
-        logging.info('add interceptor: {!s}'.format(func))
-
-    def run(self, port=9000, host='127.0.0.1'):
-        from wsgiref.simple_server import make_server
+        logging.debug('add interceptor: {!s}'.format(func))
 
+    def run(self, port=9000, host='127.0.0.1', server='wsgiref', debug=None, **kwargs):
+        """
+        :param server: 'wsgiref' for the development server, 'prefork' for server.PreforkServer,
+                       'threaded' for server.ThreadPoolServer
+        :param debug: tracebacks in 500 responses and /static/ served, by default only with 'wsgiref'
+        :param kwargs: options of the chosen server
+        """
+        if debug is None:
+            debug = server == 'wsgiref'
         logging.info('application {} will start at {}:{}'.format(self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
-        server.serve_forever()
+        if server == 'threaded':
+            from server import ThreadPoolServer
+            httpd = ThreadPoolServer(self.get_wsgi_application(debug=debug), host, port, **kwargs)
+            httpd.serve_forever()
+            return
+        if server == 'prefork':
+            from server import PreforkServer
+            PreforkServer(self.get_wsgi_application(debug=debug), host, port, **kwargs).run()
+            return
+        from wsgiref.simple_server import make_server
+        httpd = make_server(host, port, self.get_wsgi_application(debug=debug))
+        httpd.serve_forever()
 
     def get_wsgi_application(self, debug=False):
         self._check_out_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
+        if debug or self._static is not None:
+            options = dict(self._static or {})
+            precompress = options.pop('precompress', False)
+            if options.get('cache_dir'):
+                options['cache_dir'] = os.path.join(self._document_root, options['cache_dir'])
+            static_route = StaticFileRoute(**options)
+            if precompress:
+                static_route.precompress(os.path.join(self._document_root, 'static'))
+            self._get_dynamic.append(static_route)
+        if self._metrics is not None:
+            options = dict(self._metrics)
+            metrics_path = options.pop('path', '/metrics')
+            allow = tuple(options.pop('allow', ('127.0.0.1', '::1')))
+            token = options.pop('token', None)
+            import metrics
+            request_metrics = metrics.RequestMetrics(**options)
+
+            @no_admission
+            @no_interceptor
+            @get(metrics_path)
+            def metrics_endpoint():
+                if not metrics.authorized(ctx.request.environ, allow, token):
+                    raise forbidden()
+                ctx.response.content_type = metrics.CONTENT_TYPE
+                return metrics.registry.render()
+
+            self._get_static[metrics_path] = Route(metrics_endpoint)
+        admission = None
+        if self._admission is not None:
+            from admission import AdmissionController
+            admission = AdmissionController(**self._admission)
+            if self._metrics is not None:
+                metrics.registry.add_collector(admission.collect)
         self._running = True
-        _application = Nameddict(document_root=self._document_root)
+        global _etag_salt
+        salt = self._etag_salt
+        if salt is None and self._template_engine is not None:
+            salt = self._template_engine.fingerprint()
+        _etag_salt = str(salt or '').encode('utf8')
+        _application = Nameddict(document_root=self._document_root, template_engine=self._template_engine)
+
+        def chain(route):
+            name = _admission_class(route)
+            budget = admission.budget_for(route, name) if admission and name else None
+            return route.path, _build_interceptor_chain(route, *self._interceptors), budget
+
+        routes = {
+            'GET': ({path: chain(route) for path, route in self._get_static.items()},
+                    _Dispatcher(self._get_dynamic, chain)),
+            'POST': ({path: chain(route) for path, route in self._post_static.items()},
+                     _Dispatcher(self._post_dynamic, chain)),
+        }
 
         def fn_route():
             request_method = ctx.request.request_method
             path_info = ctx.request.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            raise badrequest()
-
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+            if request_method not in routes:
+                raise badrequest()
+            static, dispatcher = routes[request_method]
+            target = static.get(path_info, None)
+            args = ()
+            if target is None:
+                target, args = dispatcher.match(path_info)
+                if target is None:
+                    raise notfound()
+            environ = ctx.request.environ
+            environ['transwarp.route'], fn, budget = target
+            if budget is not None:
+                if not budget.acquire():
+                    ctx.response.set_header('Retry-After', str(admission.retry_after))
+                    raise HttpError(503)
+                environ['transwarp.admission'] = budget
+            return fn(*args)
+
+        compressor = ResponseCompressor(**self._compression) if self._compression is not None else None
 
         def wsgi(environ, start_response):
+            _ctx_var.set({})
             ctx.application = _application
-            ctx.request = Request(environ)
+            request = ctx.request = Request(environ, self._form_parser, self._session_store)
             response = ctx.response = Response()
             try:
-                r = fn_exec()
-                start_response(response.status, response.headers)
+                r = fn_route()
+                if isinstance(r, Template) and _not_modified_response(ctx.request, response):
+                    r = None
                 if isinstance(r, Template):
-                    r = self._template_engine(r.template_name, r.model)
-                    yield r.encode('utf8')
-                elif isinstance(r,GeneratorType):
-                    for subr in r:
-                        yield subr
-                else:
-                    yield r.encode('utf8')
+                    if self._template_engine.streaming:
+                        r = self._template_engine.stream(r.template_name, r.model)
+                    else:
+                        r = [self._template_engine(r.template_name, r.model).encode('utf8')]
+                elif isinstance(r, str):
+                    r = [r.encode('utf8')]
+                elif isinstance(r, bytes):
+                    r = [r]
+                elif r is None:
+                    r = []
+                if compressor is not None:
+                    r = compressor(environ, response, r)
+                request.save_session(response)
+                start_response(response.status, response.headers)
+                # last, so the finally below still releases the slot when anything above fails
+                if not isinstance(r, list) and 'transwarp.admission' in environ:
+                    r = environ.pop('transwarp.admission').release_after(r)
+                return r
             except RedirectError as e:
                 response.set_header('Location', e.location)
+                request.save_session(response)
                 start_response(e.status, response.headers)
+                return []
             except HttpError as e:
                 response.set_header('Content-type','text/plain')
+                request.save_session(response)
                 start_response(e.status, response.headers)
-                yield b'Not Found'
+                return [e.status[4:].encode('utf8')]
                 # return ['<html><body><h1>{}</h1></body></html>'.format(e.status).encode('utf8')]
             except Exception as e:
                 logging.exception(e)
@@ -615,12 +1738,33 @@ class WSGIApplication:
                     _quote(stacks).encode('utf8'),
                     b'</pre></div></body></html>']
             finally:
+                budget = environ.pop('transwarp.admission', None)
+                if budget is not None:
+                    budget.release()
                 del ctx.application
                 del ctx.request
                 del ctx.response
 
+        if self._profiling is not None:
+            from profiling import RequestProfiler
+            options = dict(self._profiling)
+            if self._document_root:
+                options['directory'] = os.path.join(self._document_root, options['directory'])
+            wsgi = RequestProfiler(**options).wrap(wsgi)
+        if self._metrics is not None:
+            wsgi = request_metrics.wrap(wsgi)
+        self._wsgi = wsgi
         return wsgi
 
+    def get_asgi_application(self, debug=False, **kwargs):
+        """
+        Serve the application over ASGI. Handlers run unchanged on a bounded
+        thread pool, see asgi.ASGIApplication for the options.
+        """
+        from asgi import ASGIApplication
+        wsgi = self._wsgi if self._wsgi is not None else self.get_wsgi_application(debug)
+        return ASGIApplication(wsgi, **kwargs)
+
 
 
 
@@ -12,6 +12,8 @@ import logging
 logging.basicConfig(level=logging.INFO)
 
 import db
+import metrics
+import startup
 from web import WSGIApplication,Jinja2TemplateEngine
 from config import configs
 
@@ -29,24 +31,57 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
-db.create_engine(**configs.db)
+with startup.phase('create_engine'):
+    db.create_engine(**configs.db)
+    db.add_statement_listener(metrics.record_statement)
+    metrics.registry.add_collector(db.engine.pool.collect)
 
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+with startup.phase('WSGIApplication'):
+    wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), static=configs.static,
+                          compression=configs.compression,
+                          page_cache=configs.cache,
+                          metrics=configs.metrics,
+                          profiling=configs.profiling,
+                          admission=configs.admission,
+                          session_store=configs.session_store)
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
-template_engine.add_filter('datetime', datetime_filter)
-wsgi.template_engine = template_engine
+with startup.phase('templates'):
+    template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'),
+                                           cache_bytecode=configs.templates.cache_bytecode,
+                                           bytecode_cache_dir=configs.templates.bytecode_cache_dir,
+                                           auto_reload=configs.templates.auto_reload,
+                                           stream=configs.templates.stream)
+    template_engine.add_filter('datetime', datetime_filter)
+    if configs.templates.precompile:
+        template_engine.precompile()
+    wsgi.template_engine = template_engine
 
 
-import urls
+with startup.phase('import urls'):
+    import urls
 
 
-wsgi.add_interceptor(urls.user_interceptor)
-wsgi.add_interceptor(urls.manager_interceptor)
-wsgi.add_module(urls)
+with startup.phase('add_module'):
+    wsgi.add_interceptor(urls.user_interceptor)
+    wsgi.add_interceptor(urls.manager_interceptor)
+    wsgi.add_module(urls)
 
 
 if __name__=='__main__':
-    wsgi.run(9000,host='0.0.0.0')
+    options = dict(configs.server)
+    if options.get('server') == 'prefork':
+        # workers started on SIGHUP import the application from disk again
+        options.setdefault('app_module', 'wsgiapp:application')
+    wsgi.run(9000,host='0.0.0.0',**options)
 else:
-    application = wsgi.get_wsgi_application()
\ No newline at end of file
+    with startup.phase('get_wsgi_application'):
+        # run() builds the first prefork generation with the same debug
+        application = wsgi.get_wsgi_application(debug=bool(configs.server.debug))
+
+    def __getattr__(name):
+        # the ASGI callable is built on first access, WSGI servers never import asyncio
+        if name == 'asgi_application':
+            global asgi_application
+            asgi_application = wsgi.get_asgi_application()
+            return asgi_application
+        raise AttributeError("module 'wsgiapp' has no attribute '{}'".format(name))